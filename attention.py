@@ -2,7 +2,6 @@ import logging
 import numpy as np
 import theano, theano.tensor as T
 from blocks.bricks.base import application
-import blocks.bricks.conv as conv2d, conv3d
 import util, bricks, initialization, masonry, graph
 
 logger = logging.getLogger(__name__)
@@ -32,8 +31,10 @@ class RecurrentAttentionModel(object):
         self.children = []
 
         self.rnn = bricks.RecurrentStack(
-            [bricks.LSTM(activation=bricks.Tanh(), dim=hidden_dim),
-             bricks.LSTM(activation=bricks.Tanh(), dim=hidden_dim)],
+            [bricks.LSTM(activation=bricks.Tanh(), dim=hidden_dim,
+                         fused=hyperparameters.get("fused_lstm", False)),
+             bricks.LSTM(activation=bricks.Tanh(), dim=hidden_dim,
+                         fused=hyperparameters.get("fused_lstm", False))],
             weights_init=initialization.NormalizedInitialization(
                 initialization.IsotropicGaussian()),
             biases_init=initialization.Constant(0))
@@ -45,15 +46,23 @@ class RecurrentAttentionModel(object):
         self.construct_locator(**hyperparameters)
         self.construct_merger(**hyperparameters)
 
-        self.embedder = bricks.Linear(
-            name="embedder",
-            input_dim=self.response_mlp.output_dim,
-            output_dim=self.rnn.get_dim("inputs"),
-            use_bias=True,
-            weights_init=initialization.Orthogonal(),
-            biases_init=initialization.Constant(0))
-
-        self.children.extend([self.rnn, self.cropper, self.embedder])
+        self.packed_input_projection = hyperparameters.get(
+            "packed_input_projection", False)
+        if self.packed_input_projection:
+            # let the lower LSTM project the responses itself, together
+            # with its states
+            self.rnn.transitions[0].input_dim = self.response_mlp.output_dim
+            self.embedder = None
+            self.children.extend([self.rnn, self.cropper])
+        else:
+            self.embedder = bricks.Linear(
+                name="embedder",
+                input_dim=self.response_mlp.output_dim,
+                output_dim=self.rnn.get_dim("inputs"),
+                use_bias=True,
+                weights_init=initialization.Orthogonal(),
+                biases_init=initialization.Constant(0))
+            self.children.extend([self.rnn, self.cropper, self.embedder])
 
     def initialize(self):
         for child in self.children:
@@ -66,6 +75,11 @@ class RecurrentAttentionModel(object):
             for i in xrange(4):
                 W[:, (i * n):((i + 1) * n)] = 0.95 * identity.generate(lstm.rng, (W.shape[0], n))
             lstm.W_state.set_value(W)
+        if self.packed_input_projection:
+            # initialize as the embedder would be
+            lstm = self.rnn.transitions[0]
+            initialization.Orthogonal().initialize(lstm.W_input, lstm.rng)
+            initialization.Constant(0).initialize(lstm.b_input, lstm.rng)
 
     @util.checkargs
     def construct_merger(self, n_spatial_dims, n_channels,
@@ -176,16 +190,26 @@ class RecurrentAttentionModel(object):
         graph.add_transform([scope.patch],
                             graph.WhiteNoiseTransform("patch_std"),
                             reason="regularization")
+        patch_features = self.patch_transform.apply(scope.patch)
+        # optionally recompute the crop and the patch network during
+        # backprop rather than keeping their intermediate results
+        graph.add_transform([patch_features],
+                            graph.RematerializeTransform(
+                                [scope.true_location, scope.true_scale]),
+                            reason="rematerialization")
         scope.response = self.response_mlp.apply(
             T.concatenate([
-                self.patch_transform.apply(scope.patch),
+                patch_features,
                 self.merge_mlp.apply(
                     T.concatenate([
                         scope.raw_location,
                         scope.raw_scale
                     ], axis=1)),
             ], axis=1))
-        embedding = self.embedder.apply(scope.response)
+        if self.packed_input_projection:
+            embedding = scope.response
+        else:
+            embedding = self.embedder.apply(scope.response)
         scope.rnn_inputs = dict(
             inputs=embedding,
             **scope.previous_states)
@@ -224,9 +248,8 @@ class RecurrentAttentionModel(object):
         from blocks.roles import INPUT, has_roles
         bricks_ = [brick for brick in
                    util.all_bricks([self.patch_transform])
-                   if isinstance(brick, (bricks.Linear,
-                                         conv2d.Convolutional,
-                                         conv3d.Convolutional))]
+                   if isinstance(brick, (bricks.Linear,) +
+                                 util.get_convolution_classes())]
         variables = [var for var in graph.deep_ancestors(variables)
                      if (has_roles(var, [INPUT]) and
                          any(brick in var.tag.annotations for brick in bricks_))]
@@ -0,0 +1,199 @@
+"""measure CPU training throughput of the configured model across BLAS and
+OpenMP thread counts and batch sizes.
+
+each configuration runs in a fresh process, because the thread counts of
+the BLAS libraries are fixed when they are loaded.  the workers compile the
+training function with theano's profiler enabled and report examples per
+second and the time spent per op type.
+
+    python benchmark.py --hyperparameters foo.yaml --threads 1 2 4 8 \\
+        --batch-sizes 50 100 --iterations 20
+
+with --startup, instead measure how long it takes a fresh process to
+import the given modules and which of the heavy optional modules they
+pull in:
+
+    python benchmark.py --startup main tasks.ucf101 --repeats 5
+"""
+import os, sys, time, json, logging, tempfile, subprocess
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+THREAD_VARIABLES = "OMP_NUM_THREADS MKL_NUM_THREADS OPENBLAS_NUM_THREADS".split()
+# modules that should be imported only by those who need them
+HEAVY_MODULES = "theano.sandbox.cuda h5py PIL fuel.datasets".split()
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.time()
+import %(module)s
+duration = time.time() - start
+json.dump(dict(seconds=duration,
+               loaded=[name for name in %(heavy_modules)r if name in sys.modules]),
+          sys.stdout)
+"""
+
+def measure_import(module, n_repeats):
+    # import in fresh processes; the first run also warms the disk cache
+    # and theano's compilation cache, so it is discarded
+    results = []
+    for i in xrange(n_repeats + 1):
+        output = subprocess.check_output(
+            [sys.executable, "-c", IMPORT_SCRIPT % dict(
+                module=module, heavy_modules=HEAVY_MODULES)],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        # theano may print to stdout; the result is on the last line
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    results = results[1:]
+    return dict(seconds=np.median([result["seconds"] for result in results]),
+                loaded=results[-1]["loaded"])
+
+def report_startup(results):
+    from tabulate import tabulate
+    print tabulate([(module, result["seconds"], " ".join(result["loaded"]))
+                    for module, result in results.items()],
+                   headers="module seconds heavy_modules_loaded".split())
+
+def run_configuration(hyperparameters_path, batch_size, n_threads,
+                      n_iterations, n_warmup_iterations):
+    # run `benchmark` in a child process with the given thread count
+    env = dict(os.environ)
+    for key in THREAD_VARIABLES:
+        env[key] = str(n_threads)
+    env["THEANO_FLAGS"] = ",".join(filter(None, [
+        env.get("THEANO_FLAGS"), "device=cpu",
+        "openmp=%s" % (n_threads > 1)]))
+    handle, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    try:
+        command = [sys.executable, os.path.abspath(__file__), "--worker",
+                   "--result-path", result_path,
+                   "--batch-sizes", str(batch_size),
+                   "--iterations", str(n_iterations),
+                   "--warmup-iterations", str(n_warmup_iterations)]
+        if hyperparameters_path:
+            command.extend(["--hyperparameters", hyperparameters_path])
+        subprocess.check_call(command, env=env)
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+def op_times(profile):
+    # seconds spent per op type
+    times = OrderedDict()
+    for key, seconds in profile.apply_time.items():
+        # keys are (fgraph, node) in newer theano
+        node = key[1] if isinstance(key, tuple) else key
+        name = type(node.op).__name__
+        times[name] = times.get(name, 0.) + seconds
+    return times
+
+def benchmark(hyperparameters, n_iterations, n_warmup_iterations):
+    import theano
+    theano.config.profile = True
+    import main, tasks
+
+    task = tasks.get_task(**hyperparameters)
+    hyperparameters["n_channels"] = task.n_channels
+    graphs, outputs, updates = main.construct_graphs(task=task, **hyperparameters)
+    algorithm = main.construct_algorithm(
+        graphs=graphs, outputs=outputs, updates=updates, **hyperparameters)
+    algorithm.initialize()
+
+    rng = np.random.RandomState(1)
+    example_batch = task.get_example_batch(hyperparameters["batch_size"], rng)
+    batch = OrderedDict((variable.name, example_batch[variable.name])
+                        for variable in algorithm.inputs)
+
+    for i in xrange(n_warmup_iterations):
+        algorithm.process_batch(batch)
+    # start profiling afresh so that the warmup is excluded
+    profile = theano.compile.profiling.ProfileStats(atexit_print=False)
+    algorithm._function.profile = profile
+
+    start = time.time()
+    for i in xrange(n_iterations):
+        algorithm.process_batch(batch)
+    duration = time.time() - start
+
+    return dict(
+        seconds_per_iteration=duration / n_iterations,
+        examples_per_second=n_iterations * hyperparameters["batch_size"] / duration,
+        op_seconds_per_iteration=OrderedDict(
+            (name, seconds / n_iterations)
+            for name, seconds in op_times(profile).items()))
+
+def report(results, n_top_ops=10):
+    from tabulate import tabulate
+    rows = []
+    for batch_size, results_by_threads in results.items():
+        base_threads = min(results_by_threads.keys())
+        base = results_by_threads[base_threads]["examples_per_second"]
+        for n_threads, result in sorted(results_by_threads.items()):
+            speedup = result["examples_per_second"] / base
+            rows.append((batch_size, n_threads,
+                         result["examples_per_second"],
+                         1000 * result["seconds_per_iteration"],
+                         speedup, speedup * base_threads / n_threads))
+    print tabulate(rows, headers="batch_size threads examples/s ms/iteration speedup efficiency".split())
+
+    for batch_size, results_by_threads in results.items():
+        for n_threads, result in sorted(results_by_threads.items()):
+            times = result["op_seconds_per_iteration"]
+            total = sum(times.values())
+            rows = [(name, 1000 * seconds, 100 * seconds / total)
+                    for name, seconds in sorted(times.items(), key=lambda item: -item[1])[:n_top_ops]]
+            print
+            print "batch size %i, %i threads:" % (batch_size, n_threads)
+            print tabulate(rows, headers="op ms/iteration %".split())
+
+if __name__ == "__main__":
+    logging.basicConfig()
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hyperparameters", help="YAML file from which to load hyperparameters")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--batch-sizes", type=int, nargs="+")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup-iterations", type=int, default=2)
+    parser.add_argument("--startup", nargs="+", metavar="MODULE", help="measure import time of these modules instead")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result-path", help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.startup:
+        results = OrderedDict()
+        for module in args.startup:
+            print "importing %s..." % module
+            results[module] = measure_import(module, args.repeats)
+        report_startup(results)
+    elif args.worker:
+        import main
+        hyperparameters = main.load_hyperparameters(args.hyperparameters)
+        hyperparameters["batch_size"], = args.batch_sizes
+        result = benchmark(hyperparameters, args.iterations, args.warmup_iterations)
+        with open(args.result_path, "w") as f:
+            json.dump(result, f)
+    else:
+        batch_sizes = args.batch_sizes
+        if not batch_sizes:
+            import yaml
+            with open(args.hyperparameters or os.path.join(
+                    os.path.dirname(__file__), "defaults.yaml")) as f:
+                batch_sizes = [yaml.load(f)["batch_size"]]
+        results = OrderedDict()
+        for batch_size in batch_sizes:
+            results[batch_size] = OrderedDict()
+            for n_threads in args.threads:
+                print "benchmarking batch size %i with %i threads..." % (batch_size, n_threads)
+                results[batch_size][n_threads] = run_configuration(
+                    args.hyperparameters, batch_size, n_threads,
+                    args.iterations, args.warmup_iterations)
+        report(results)
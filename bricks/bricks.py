@@ -14,7 +14,7 @@ from blocks.utils import shared_floatx_nans, shared_floatx_zeros
 import blocks.bricks as bricks
 from blocks.bricks.conv import Flattener
 
-import initialization, graph, util
+import initialization, graph, util, ops
 
 logger = logging.getLogger(__name__)
 
@@ -170,12 +170,15 @@ class BatchNormalization(bricks.Initializable, bricks.Feedforward):
         mean=BatchMeanRole(),
         var=BatchVarRole())
 
-    def __init__(self, shape, broadcastable, alpha=1e-2, epsilon=1e-8, **kwargs):
+    def __init__(self, shape, broadcastable, alpha=1e-2, epsilon=1e-8,
+                 fused_statistics=False, **kwargs):
         super(BatchNormalization, self).__init__(**kwargs)
         self.shape = shape
         self.broadcastable = list(broadcastable)
         self.alpha = alpha
         self.epsilon = epsilon
+        # compute mean and var in a single pass with ops.MeanVar
+        self.fused_statistics = fused_statistics
 
     def _allocate(self):
         parameter_shape = [1] + [1 if broadcast else dim for dim, broadcast
@@ -209,10 +212,13 @@ class BatchNormalization(bricks.Initializable, bricks.Feedforward):
         aggregate_axes = [0] + [1 + i for i, b in enumerate(self.broadcastable) if b]
         # NOTE: don't put batch_stats on self because apply may be
         # called multiple times
-        batch_stats = dict(
-            (stat, getattr(input_, stat)(axis=aggregate_axes,
-                                         keepdims=True))
-            for stat in self.stats)
+        if self.fused_statistics:
+            batch_stats = self.compute_fused_statistics(input_, aggregate_axes)
+        else:
+            batch_stats = dict(
+                (stat, getattr(input_, stat)(axis=aggregate_axes,
+                                             keepdims=True))
+                for stat in self.stats)
 
         for stat, role in self.roles.items():
             graph.add_transform([batch_stats[stat]],
@@ -231,10 +237,45 @@ class BatchNormalization(bricks.Initializable, bricks.Feedforward):
 
         gamma = T.patternbroadcast(self.gamma, [True] + self.broadcastable)
         beta = T.patternbroadcast(self.beta, [True] + self.broadcastable)
-        return theano.tensor.nnet.bn.batch_normalization(
+        output = theano.tensor.nnet.bn.batch_normalization(
             inputs=input_, gamma=gamma, beta=beta,
             mean=batch_stats["mean"],
             std=T.sqrt(batch_stats["var"] + self.epsilon))
+        graph.add_transform([output],
+                            graph.FoldedBatchNormalizationTransform(self, input_),
+                            reason="batch_normalization_folding")
+        return output
+
+    def get_folded_scale_shift(self):
+        # inference-mode batch normalization as an affine transform
+        # `input_ * scale + shift`, e.g. for exporting the model
+        pattern = [True] + self.broadcastable
+        mean, var, gamma, beta = [
+            T.patternbroadcast(parameter, pattern)
+            for parameter in (self.population_stats["mean"],
+                              self.population_stats["var"],
+                              self.gamma, self.beta)]
+        scale = gamma / T.sqrt(var + self.epsilon)
+        shift = beta - mean * scale
+        return scale, shift
+
+    def compute_fused_statistics(self, input_, aggregate_axes):
+        # bring the aggregate axes to the front and flatten into a
+        # matrix for MeanVar, then restore the keepdims shape
+        other_axes = [i for i in range(input_.ndim) if i not in aggregate_axes]
+        x = input_.dimshuffle(aggregate_axes + other_axes)
+        x = x.reshape((T.prod(x.shape[:len(aggregate_axes)]),
+                       T.prod(x.shape[len(aggregate_axes):])),
+                      ndim=2)
+        shape = [1 if i in aggregate_axes else input_.shape[i]
+                 for i in range(input_.ndim)]
+        broadcastable = [i in aggregate_axes or input_.broadcastable[i]
+                         for i in range(input_.ndim)]
+        return dict(
+            (stat, T.patternbroadcast(
+                statistic.reshape(shape, ndim=input_.ndim),
+                broadcastable))
+            for stat, statistic in zip(self.stats, ops.mean_var(x)))
 
     @staticmethod
     def get_updates(variables):
@@ -260,7 +301,8 @@ class BatchNormalization(bricks.Initializable, bricks.Feedforward):
                     # makes sense for recurrent structures
                     logger.warning("averaging multiple population statistic estimates to update %s: %s"
                                    % (util.get_path(population_stat), batch_stats))
-                batch_stat = T.stack(batch_stats).mean(axis=0)
+                # running sum rather than stacking all estimates
+                batch_stat = reduce(operator.add, batch_stats) / len(batch_stats)
                 updates.append((population_stat,
                                 (1 - brick.alpha) * population_stat
                                 + brick.alpha * batch_stat))
@@ -430,6 +472,15 @@ class LSTM(BaseRecurrent, Initializable):
     activation : :class:`.Brick`, optional
         The activation function. The default and by far the most popular
         is :class:`.Tanh`.
+    fused : bool, optional
+        Whether to compute the gates, cell update and output in a single
+        :class:`.ops.FusedLSTMCell` op rather than as separate elementwise
+        ops. Requires the activation to be :class:`.Tanh`.
+    input_dim : int, optional
+        If given, the brick takes untransformed inputs of this dimension
+        and applies its own input projection. The input and recurrent
+        projections are then computed together in a single matrix
+        product per step.
 
     Notes
     -----
@@ -437,16 +488,23 @@ class LSTM(BaseRecurrent, Initializable):
 
     """
     @lazy(allocation=['dim'])
-    def __init__(self, dim, activation=None, **kwargs):
+    def __init__(self, dim, activation=None, fused=False, input_dim=None,
+                 **kwargs):
         super(LSTM, self).__init__(**kwargs)
         self.dim = dim
+        self.fused = fused
+        self.input_dim = input_dim
 
         if not activation:
             activation = Tanh()
+        if fused and not isinstance(activation, Tanh):
+            raise ValueError("fused LSTM requires Tanh activation")
         self.children = [activation]
 
     def get_dim(self, name):
         if name == 'inputs':
+            if self.input_dim:
+                return self.input_dim
             return self.dim * 4
         if name in ['states', 'cells']:
             return self.dim
@@ -480,9 +538,21 @@ class LSTM(BaseRecurrent, Initializable):
             self.W_state, self.W_cell_to_in, self.W_cell_to_forget,
             self.W_cell_to_out, self.initial_state_, self.initial_cells]
 
+        if self.input_dim:
+            self.W_input = shared_floatx_nans((self.input_dim, 4*self.dim),
+                                              name='W_input')
+            self.b_input = shared_floatx_nans((4*self.dim,),
+                                              name='b_input')
+            add_role(self.W_input, WEIGHT)
+            add_role(self.b_input, BIAS)
+            self.parameters.extend([self.W_input, self.b_input])
+
     def _initialize(self):
         for weights in self.parameters[:4]:
             self.weights_init.initialize(weights, self.rng)
+        if self.input_dim:
+            self.weights_init.initialize(self.W_input, self.rng)
+            self.biases_init.initialize(self.b_input, self.rng)
 
     @recurrent(sequences=['inputs', 'mask'], states=['states', 'cells'],
                contexts=[], outputs=['states', 'cells'])
@@ -528,18 +598,31 @@ class LSTM(BaseRecurrent, Initializable):
 
         nonlinearity = self.children[0].apply
 
-        activation = tensor.dot(states, W_state) + inputs
-        in_gate = tensor.nnet.sigmoid(slice_last(activation, 0) +
-                                      cells * self.W_cell_to_in)
-        forget_gate = tensor.nnet.sigmoid(slice_last(activation, 1) +
-                                          cells * self.W_cell_to_forget +
-                                          # forget gate bias
-                                          1)
-        next_cells = (forget_gate * cells +
-                      in_gate * nonlinearity(slice_last(activation, 2)))
-        out_gate = tensor.nnet.sigmoid(slice_last(activation, 3) +
-                                       next_cells * self.W_cell_to_out)
-        next_states = out_gate * nonlinearity(next_cells)
+        if self.input_dim:
+            # one product for both projections; the concatenated weight
+            # matrix is shared between steps
+            activation = tensor.dot(
+                tensor.concatenate([inputs, states], axis=1),
+                tensor.concatenate([self.W_input, W_state], axis=0)
+            ) + self.b_input
+        else:
+            activation = tensor.dot(states, W_state) + inputs
+        if self.fused:
+            next_states, next_cells = ops.fused_lstm_cell(
+                activation, cells, self.W_cell_to_in,
+                self.W_cell_to_forget, self.W_cell_to_out)
+        else:
+            in_gate = tensor.nnet.sigmoid(slice_last(activation, 0) +
+                                          cells * self.W_cell_to_in)
+            forget_gate = tensor.nnet.sigmoid(slice_last(activation, 1) +
+                                              cells * self.W_cell_to_forget +
+                                              # forget gate bias
+                                              1)
+            next_cells = (forget_gate * cells +
+                          in_gate * nonlinearity(slice_last(activation, 2)))
+            out_gate = tensor.nnet.sigmoid(slice_last(activation, 3) +
+                                           next_cells * self.W_cell_to_out)
+            next_states = out_gate * nonlinearity(next_cells)
 
         if mask:
             next_states = (mask[:, None] * next_states +
@@ -547,6 +630,8 @@ class LSTM(BaseRecurrent, Initializable):
             next_cells = (mask[:, None] * next_cells +
                           (1 - mask[:, None]) * cells)
 
+        util.tag_profile_origin([inputs, states, cells],
+                                [next_states, next_cells], "lstm")
         return next_states, next_cells
 
     @application(outputs=apply.states)
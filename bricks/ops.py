@@ -0,0 +1,368 @@
+import numpy as np
+import theano
+import theano.tensor as T
+from theano import Apply, Op
+from theano.gradient import DisconnectedType
+
+# the LSTM cell nonlinearities, gate peepholes and cell update in a
+# single pass over the (batch_size, 4*dim) preactivation buffer.  the
+# gate layout and the forget gate bias of 1 match bricks.LSTM.apply.
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def lstm_cell_forward(activation, cells, w_in, w_forget, w_out):
+    dim = cells.shape[1]
+    a_in, a_forget, a_cell, a_out = [activation[:, i*dim:(i+1)*dim]
+                                     for i in range(4)]
+    in_gate = sigmoid(a_in + cells * w_in)
+    forget_gate = sigmoid(a_forget + cells * w_forget + 1)
+    cell_input = np.tanh(a_cell)
+    next_cells = forget_gate * cells + in_gate * cell_input
+    out_gate = sigmoid(a_out + next_cells * w_out)
+    tanh_cells = np.tanh(next_cells)
+    next_states = out_gate * tanh_cells
+    return (next_states, next_cells,
+            in_gate, forget_gate, cell_input, out_gate, tanh_cells)
+
+def c_dtype(variable):
+    return variable.type.dtype_specs()[1]
+
+def c_typenum(variable):
+    return variable.type.dtype_specs()[2]
+
+def c_check_shape(var, shape, name, fail):
+    # `shape` is a sequence of C expressions
+    conditions = ["PyArray_NDIM(%s) != %i" % (var, len(shape))]
+    conditions.extend("PyArray_DIMS(%s)[%i] != %s" % (var, i, dim)
+                      for i, dim in enumerate(shape))
+    return """
+    if (%(condition)s) {
+        PyErr_SetString(PyExc_ValueError, "%(name)s has wrong shape");
+        %(fail)s;
+    }
+    """ % dict(condition=" || ".join(conditions), name=name, fail=fail)
+
+def c_allocate(var, shape, typenum, fail):
+    # (re)allocate output `var` unless it already has the right shape
+    conditions = ["NULL == %s" % var,
+                  "PyArray_NDIM(%s) != %i" % (var, len(shape))]
+    conditions.extend("PyArray_DIMS(%s)[%i] != %s" % (var, i, dim)
+                      for i, dim in enumerate(shape))
+    return """
+    if (%(condition)s) {
+        npy_intp dims[%(ndim)i] = {%(shape)s};
+        Py_XDECREF(%(var)s);
+        %(var)s = (PyArrayObject*)PyArray_EMPTY(%(ndim)i, dims, %(typenum)s, 0);
+        if (NULL == %(var)s) {
+            PyErr_SetString(PyExc_MemoryError, "failed to allocate %(var)s");
+            %(fail)s;
+        }
+    }
+    """ % dict(condition=" || ".join(conditions), ndim=len(shape),
+               shape=", ".join(shape), var=var, typenum=typenum, fail=fail)
+
+C_SUPPORT_CODE = """
+#define LSTM_AT1(type, x, i) (*(type*)PyArray_GETPTR1(x, i))
+#define LSTM_AT2(type, x, i, j) (*(type*)PyArray_GETPTR2(x, i, j))
+static inline double lstm_sigmoid(double x) { return 1. / (1. + exp(-x)); }
+"""
+
+class FusedLSTMCell(Op):
+    """compute (next_states, next_cells) from the preactivation
+    `dot(states, W_state) + inputs`, the cells and the three peephole
+    weight vectors.  the cell nonlinearity is tanh."""
+    __props__ = ()
+
+    def make_node(self, activation, cells, w_in, w_forget, w_out):
+        inputs = list(map(T.as_tensor_variable,
+                          (activation, cells, w_in, w_forget, w_out)))
+        for input, ndim in zip(inputs, (2, 2, 1, 1, 1)):
+            if input.ndim != ndim:
+                raise TypeError("expected %i dimensions for %s" % (ndim, input))
+            if input.dtype != inputs[0].dtype:
+                raise TypeError("all inputs should have the same dtype")
+        return Apply(self, inputs, [inputs[1].type(), inputs[1].type()])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[1], shapes[1]]
+
+    def perform(self, node, inputs, output_storage):
+        results = lstm_cell_forward(*inputs)
+        for storage, result in zip(output_storage, results[:2]):
+            storage[0] = result.astype(node.outputs[0].dtype)
+
+    def grad(self, inputs, output_grads):
+        dstates, dcells = output_grads
+        if isinstance(dstates.type, DisconnectedType):
+            dstates = T.zeros_like(inputs[1])
+        if isinstance(dcells.type, DisconnectedType):
+            dcells = T.zeros_like(inputs[1])
+        return FusedLSTMCellGrad()(*(list(inputs) + [dstates, dcells]))
+
+    def c_support_code(self):
+        return C_SUPPORT_CODE
+
+    def c_code_cache_version(self):
+        return (1,)
+
+    def c_code(self, node, nodename, inputs, outputs, sub):
+        a, c, pi, pf, po = inputs
+        h, c1 = outputs
+        fail = sub["fail"]
+        dtype = c_dtype(node.inputs[0])
+        typenum = c_typenum(node.outputs[0])
+        batch, dim = "PyArray_DIMS(%s)[0]" % c, "PyArray_DIMS(%s)[1]" % c
+        strings = [
+            c_check_shape(a, (batch, "4*" + dim), "activation", fail),
+            c_check_shape(pi, (dim,), "w_in", fail),
+            c_check_shape(pf, (dim,), "w_forget", fail),
+            c_check_shape(po, (dim,), "w_out", fail),
+            c_allocate(h, (batch, dim), typenum, fail),
+            c_allocate(c1, (batch, dim), typenum, fail)]
+        strings.append("""
+        {
+            const npy_intp batch = %(batch)s, dim = %(dim)s;
+            for (npy_intp b = 0; b < batch; b++) {
+                for (npy_intp j = 0; j < dim; j++) {
+                    const double cell = LSTM_AT2(%(dtype)s, %(c)s, b, j);
+                    const double i = lstm_sigmoid(LSTM_AT2(%(dtype)s, %(a)s, b, j)
+                                                  + cell * LSTM_AT1(%(dtype)s, %(pi)s, j));
+                    const double f = lstm_sigmoid(LSTM_AT2(%(dtype)s, %(a)s, b, dim + j)
+                                                  + cell * LSTM_AT1(%(dtype)s, %(pf)s, j)
+                                                  + 1);
+                    const double g = tanh(LSTM_AT2(%(dtype)s, %(a)s, b, 2*dim + j));
+                    const double next_cell = f * cell + i * g;
+                    const double o = lstm_sigmoid(LSTM_AT2(%(dtype)s, %(a)s, b, 3*dim + j)
+                                                  + next_cell * LSTM_AT1(%(dtype)s, %(po)s, j));
+                    LSTM_AT2(%(dtype)s, %(c1)s, b, j) = next_cell;
+                    LSTM_AT2(%(dtype)s, %(h)s, b, j) = o * tanh(next_cell);
+                }
+            }
+        }
+        """ % locals())
+        return "\n".join(strings)
+
+class FusedLSTMCellGrad(Op):
+    """gradient of FusedLSTMCell with respect to all its inputs.  the
+    gates are recomputed from the inputs rather than stored."""
+    __props__ = ()
+
+    def make_node(self, activation, cells, w_in, w_forget, w_out,
+                  dstates, dcells):
+        inputs = list(map(T.as_tensor_variable,
+                          (activation, cells, w_in, w_forget, w_out,
+                           dstates, dcells)))
+        for input, ndim in zip(inputs, (2, 2, 1, 1, 1, 2, 2)):
+            if input.ndim != ndim:
+                raise TypeError("expected %i dimensions for %s" % (ndim, input))
+            if input.dtype != inputs[0].dtype:
+                raise TypeError("all inputs should have the same dtype")
+        return Apply(self, inputs, [input.type() for input in inputs[:5]])
+
+    def infer_shape(self, node, shapes):
+        return shapes[:5]
+
+    def perform(self, node, inputs, output_storage):
+        activation, cells, w_in, w_forget, w_out, dstates, dcells = inputs
+        (next_states, next_cells, in_gate, forget_gate,
+         cell_input, out_gate, tanh_cells) = lstm_cell_forward(
+             activation, cells, w_in, w_forget, w_out)
+        da_out = dstates * tanh_cells * out_gate * (1 - out_gate)
+        dnext_cells = (dcells + dstates * out_gate * (1 - tanh_cells**2)
+                       + da_out * w_out)
+        da_in = dnext_cells * cell_input * in_gate * (1 - in_gate)
+        da_forget = dnext_cells * cells * forget_gate * (1 - forget_gate)
+        da_cell = dnext_cells * in_gate * (1 - cell_input**2)
+        results = [
+            np.concatenate([da_in, da_forget, da_cell, da_out], axis=1),
+            dnext_cells * forget_gate + da_in * w_in + da_forget * w_forget,
+            (da_in * cells).sum(axis=0),
+            (da_forget * cells).sum(axis=0),
+            (da_out * next_cells).sum(axis=0)]
+        for storage, result, output in zip(output_storage, results, node.outputs):
+            storage[0] = result.astype(output.dtype)
+
+    def c_support_code(self):
+        return C_SUPPORT_CODE
+
+    def c_code_cache_version(self):
+        return (1,)
+
+    def c_code(self, node, nodename, inputs, outputs, sub):
+        a, c, pi, pf, po, dh, dc1 = inputs
+        da, dc, dpi, dpf, dpo = outputs
+        fail = sub["fail"]
+        dtype = c_dtype(node.inputs[0])
+        typenum = c_typenum(node.outputs[0])
+        batch, dim = "PyArray_DIMS(%s)[0]" % c, "PyArray_DIMS(%s)[1]" % c
+        strings = [
+            c_check_shape(a, (batch, "4*" + dim), "activation", fail),
+            c_check_shape(pi, (dim,), "w_in", fail),
+            c_check_shape(pf, (dim,), "w_forget", fail),
+            c_check_shape(po, (dim,), "w_out", fail),
+            c_check_shape(dh, (batch, dim), "dstates", fail),
+            c_check_shape(dc1, (batch, dim), "dcells", fail),
+            c_allocate(da, (batch, "4*" + dim), typenum, fail),
+            c_allocate(dc, (batch, dim), typenum, fail),
+            c_allocate(dpi, (dim,), typenum, fail),
+            c_allocate(dpf, (dim,), typenum, fail),
+            c_allocate(dpo, (dim,), typenum, fail)]
+        strings.append("""
+        {
+            const npy_intp batch = %(batch)s, dim = %(dim)s;
+            for (npy_intp j = 0; j < dim; j++) {
+                const double pi = LSTM_AT1(%(dtype)s, %(pi)s, j),
+                             pf = LSTM_AT1(%(dtype)s, %(pf)s, j),
+                             po = LSTM_AT1(%(dtype)s, %(po)s, j);
+                double dpi = 0, dpf = 0, dpo = 0;
+                for (npy_intp b = 0; b < batch; b++) {
+                    // recompute the forward pass
+                    const double cell = LSTM_AT2(%(dtype)s, %(c)s, b, j);
+                    const double i = lstm_sigmoid(LSTM_AT2(%(dtype)s, %(a)s, b, j) + cell * pi);
+                    const double f = lstm_sigmoid(LSTM_AT2(%(dtype)s, %(a)s, b, dim + j) + cell * pf + 1);
+                    const double g = tanh(LSTM_AT2(%(dtype)s, %(a)s, b, 2*dim + j));
+                    const double next_cell = f * cell + i * g;
+                    const double o = lstm_sigmoid(LSTM_AT2(%(dtype)s, %(a)s, b, 3*dim + j) + next_cell * po);
+                    const double tc = tanh(next_cell);
+
+                    const double dh = LSTM_AT2(%(dtype)s, %(dh)s, b, j);
+                    const double dao = dh * tc * o * (1 - o);
+                    const double dnext_cell = (LSTM_AT2(%(dtype)s, %(dc1)s, b, j)
+                                               + dh * o * (1 - tc * tc) + dao * po);
+                    const double dai = dnext_cell * g * i * (1 - i);
+                    const double daf = dnext_cell * cell * f * (1 - f);
+                    const double dag = dnext_cell * i * (1 - g * g);
+
+                    LSTM_AT2(%(dtype)s, %(da)s, b, j) = dai;
+                    LSTM_AT2(%(dtype)s, %(da)s, b, dim + j) = daf;
+                    LSTM_AT2(%(dtype)s, %(da)s, b, 2*dim + j) = dag;
+                    LSTM_AT2(%(dtype)s, %(da)s, b, 3*dim + j) = dao;
+                    LSTM_AT2(%(dtype)s, %(dc)s, b, j) = dnext_cell * f + dai * pi + daf * pf;
+
+                    dpi += dai * cell;
+                    dpf += daf * cell;
+                    dpo += dao * next_cell;
+                }
+                LSTM_AT1(%(dtype)s, %(dpi)s, j) = dpi;
+                LSTM_AT1(%(dtype)s, %(dpf)s, j) = dpf;
+                LSTM_AT1(%(dtype)s, %(dpo)s, j) = dpo;
+            }
+        }
+        """ % locals())
+        return "\n".join(strings)
+
+fused_lstm_cell = FusedLSTMCell()
+
+class MeanVar(Op):
+    """compute the mean and (biased) variance of a matrix along its
+    first axis in a single pass, using Welford's algorithm."""
+    __props__ = ()
+
+    def make_node(self, x):
+        x = T.as_tensor_variable(x)
+        if x.ndim != 2:
+            raise TypeError("expected a matrix, got %s" % x)
+        output_type = T.TensorType(dtype=x.dtype,
+                                   broadcastable=x.broadcastable[1:])
+        return Apply(self, [x], [output_type(), output_type()])
+
+    def infer_shape(self, node, shapes):
+        (n, m), = shapes
+        return [(m,), (m,)]
+
+    def perform(self, node, inputs, output_storage):
+        x, = inputs
+        output_storage[0][0] = x.mean(axis=0, dtype=x.dtype)
+        output_storage[1][0] = x.var(axis=0, dtype=x.dtype)
+
+    def grad(self, inputs, output_grads):
+        x, = inputs
+        mean, var = self(x)
+        dmean, dvar = output_grads
+        n = T.cast(x.shape[0], x.dtype)
+        dx = T.zeros_like(x)
+        if not isinstance(dmean.type, DisconnectedType):
+            dx += dmean.dimshuffle("x", 0) / n
+        if not isinstance(dvar.type, DisconnectedType):
+            dx += dvar.dimshuffle("x", 0) * 2 * (x - mean.dimshuffle("x", 0)) / n
+        return [dx]
+
+    def c_support_code(self):
+        return C_SUPPORT_CODE
+
+    def c_code_cache_version(self):
+        return (1,)
+
+    def c_code(self, node, nodename, inputs, outputs, sub):
+        x, = inputs
+        mean, var = outputs
+        fail = sub["fail"]
+        dtype = c_dtype(node.inputs[0])
+        typenum = c_typenum(node.outputs[0])
+        m = "PyArray_DIMS(%s)[1]" % x
+        strings = [
+            c_allocate(mean, (m,), typenum, fail),
+            c_allocate(var, (m,), typenum, fail)]
+        strings.append("""
+        {
+            const npy_intp n = PyArray_DIMS(%(x)s)[0], m = %(m)s;
+            for (npy_intp j = 0; j < m; j++) {
+                LSTM_AT1(%(dtype)s, %(mean)s, j) = 0;
+                LSTM_AT1(%(dtype)s, %(var)s, j) = 0;
+            }
+            // rows outer so memory is traversed in order; var holds the
+            // running sum of squared deviations until the end
+            for (npy_intp i = 0; i < n; i++) {
+                for (npy_intp j = 0; j < m; j++) {
+                    const %(dtype)s x = LSTM_AT2(%(dtype)s, %(x)s, i, j);
+                    const %(dtype)s delta = x - LSTM_AT1(%(dtype)s, %(mean)s, j);
+                    LSTM_AT1(%(dtype)s, %(mean)s, j) += delta / (i + 1);
+                    LSTM_AT1(%(dtype)s, %(var)s, j) += delta * (x - LSTM_AT1(%(dtype)s, %(mean)s, j));
+                }
+            }
+            for (npy_intp j = 0; j < m; j++) {
+                LSTM_AT1(%(dtype)s, %(var)s, j) = n > 0 ? LSTM_AT1(%(dtype)s, %(var)s, j) / n : NAN;
+                if (n == 0) LSTM_AT1(%(dtype)s, %(mean)s, j) = NAN;
+            }
+        }
+        """ % locals())
+        return "\n".join(strings)
+
+mean_var = MeanVar()
+
+if __name__ == "__main__":
+    # check the fused cell and its gradient against the unfused graph
+    rng = np.random.RandomState(1)
+    batch_size, dim = 10, 7
+    floatX = theano.config.floatX
+
+    activation, cells = T.matrix("activation"), T.matrix("cells")
+    w_in, w_forget, w_out = T.vector("w_in"), T.vector("w_forget"), T.vector("w_out")
+    inputs = [activation, cells, w_in, w_forget, w_out]
+    values = [rng.normal(size=shape).astype(floatX) for shape in
+              [(batch_size, 4*dim), (batch_size, dim), (dim,), (dim,), (dim,)]]
+
+    def slice_last(x, no):
+        return x[:, no*dim: (no+1)*dim]
+    in_gate = T.nnet.sigmoid(slice_last(activation, 0) + cells * w_in)
+    forget_gate = T.nnet.sigmoid(slice_last(activation, 1) + cells * w_forget + 1)
+    next_cells = forget_gate * cells + in_gate * T.tanh(slice_last(activation, 2))
+    out_gate = T.nnet.sigmoid(slice_last(activation, 3) + next_cells * w_out)
+    next_states = out_gate * T.tanh(next_cells)
+    reference = [next_states, next_cells]
+
+    fused = fused_lstm_cell(*inputs)
+
+    for outputs in [reference, fused]:
+        cost = (outputs[0]**2).sum() + outputs[1].sum()
+        for mode in ["FAST_COMPILE", "FAST_RUN"]:
+            f = theano.function(inputs, list(outputs) + T.grad(cost, inputs), mode=mode)
+            results = f(*values)
+            if outputs is reference:
+                expected = results
+            else:
+                for name, result, expectation in zip(
+                        "states cells activation cells w_in w_forget w_out".split(),
+                        results, expected):
+                    print mode, name, abs(result - expectation).max()
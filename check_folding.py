@@ -0,0 +1,84 @@
+"""check that folding batch normalization into the weights leaves the
+inference outputs unchanged.
+
+    python check_folding.py --hyperparameters foo.yaml
+
+builds the graphs with and without `fold_batch_normalization`, gives the
+batch normalizations the same random population statistics and affine
+parameters in both, and compares the inference outputs on an example
+batch.  the glimpses share weights, so the model should have at least two
+of them to catch folds that leak into the other glimpses.
+"""
+import sys, zlib, logging
+from collections import OrderedDict
+import numpy as np
+import theano
+
+BATCH_NORMALIZATION_NAMES = "population_mean population_var gamma beta".split()
+
+def construct_inference_outputs(hyperparameters, fold):
+    import main, tasks
+    hyperparameters = dict(hyperparameters)
+    hyperparameters["fold_batch_normalization"] = fold
+    hyperparameters["hyperparameters"] = hyperparameters
+    task = tasks.get_task(**hyperparameters)
+    hyperparameters["n_channels"] = task.n_channels
+    graphs, outputs, updates = main.construct_graphs(task=task, **hyperparameters)
+    return task, graphs["valid"], outputs["valid"]
+
+def randomize_batch_normalization(graph):
+    import util
+    for variable in graph.shared_variables:
+        if variable.name not in BATCH_NORMALIZATION_NAMES:
+            continue
+        # same values for the same variable in either graph
+        rng = np.random.RandomState(zlib.crc32(util.get_path(variable)) & 0xffffffff)
+        shape = variable.get_value().shape
+        if variable.name in "population_var gamma".split():
+            value = rng.uniform(0.5, 2., size=shape)
+        else:
+            value = rng.normal(0., 0.5, size=shape)
+        variable.set_value(value.astype(variable.dtype))
+
+def evaluate(graph, outputs, batch):
+    inputs = graph.inputs
+    function = theano.function(inputs, list(outputs.values()),
+                               on_unused_input="ignore")
+    return OrderedDict(zip(outputs.keys(),
+                           function(*[batch[input.name] for input in inputs])))
+
+def check_folding(hyperparameters, n_examples=10):
+    if hyperparameters["n_patches"] < 2:
+        raise ValueError("need at least two glimpses")
+    results = []
+    for fold in (False, True):
+        task, graph, outputs = construct_inference_outputs(hyperparameters, fold)
+        randomize_batch_normalization(graph)
+        batch = task.get_example_batch(n_examples, np.random.RandomState(1))
+        results.append(evaluate(graph, outputs, batch))
+
+    unfolded, folded = results
+    ok = True
+    for key in unfolded.keys():
+        a, b = np.asarray(unfolded[key]), np.asarray(folded[key])
+        if a.dtype.kind != "f":
+            continue
+        difference = np.abs(a - b).max() if a.size else 0.
+        match = np.allclose(a, b, rtol=1e-4, atol=1e-5)
+        print "%-20s max difference %g%s" % (key, difference, "" if match else "  MISMATCH")
+        ok = ok and match
+    return ok
+
+if __name__ == "__main__":
+    logging.basicConfig()
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hyperparameters", help="YAML file from which to load hyperparameters")
+
+    args = parser.parse_args()
+
+    import main
+    hyperparameters = main.load_hyperparameters(args.hyperparameters)
+    sys.exit(0 if check_folding(hyperparameters) else 1)
@@ -0,0 +1,70 @@
+"""check that data-parallel training runs a batch with the training data
+monitor and batch normalization in place.
+
+    python check_parallel.py --hyperparameters foo.yaml
+
+trains on one batch with `n_workers` 1 and 2 from the same initial
+parameters and prints the monitored cost and step norm of each.  batch
+normalization normalizes by shard statistics and each process draws its
+own noise, so the two differ somewhat, but both should be finite and
+close.
+"""
+import sys, logging
+import numpy as np
+
+def train_one_batch(hyperparameters, n_workers):
+    import main, tasks
+    from blocks.extensions import FinishAfter
+    from blocks.extensions.monitoring import TrainingDataMonitoring
+    from blocks.main_loop import MainLoop
+    from blocks.model import Model
+
+    hyperparameters = dict(hyperparameters)
+    hyperparameters["n_workers"] = n_workers
+    hyperparameters["monitor_options"] = "steps"
+    hyperparameters["plot_url"] = None
+    hyperparameters["hyperparameters"] = hyperparameters
+    task = tasks.get_task(**hyperparameters)
+    hyperparameters["n_channels"] = task.n_channels
+    graphs, outputs, updates = main.construct_graphs(task=task, **hyperparameters)
+    algorithm = main.construct_algorithm(graphs=graphs, outputs=outputs,
+                                         updates=updates, **hyperparameters)
+    model = Model(outputs["train"]["cost"])
+    monitors = [extension for extension in main.construct_monitors(
+                    algorithm=algorithm, task=task, model=model, graphs=graphs,
+                    outputs=outputs, updates=updates, **hyperparameters)
+                if isinstance(extension, TrainingDataMonitoring)]
+    main_loop = MainLoop(data_stream=task.get_stream("train"),
+                         algorithm=algorithm, model=model,
+                         extensions=monitors + [FinishAfter(after_n_batches=1)])
+    try:
+        main_loop.run()
+    finally:
+        if n_workers > 1:
+            algorithm.stop_workers()
+    return main_loop.log.current_row
+
+def check_parallel(hyperparameters):
+    if not hyperparameters.get("batch_normalize_patch", False):
+        logging.warning("batch_normalize_patch is off")
+    ok = True
+    for n_workers in (1, 2):
+        row = train_one_batch(hyperparameters, n_workers)
+        cost, step_norm = row["iteration_cost"], row["iteration_total_step_norm"]
+        print "n_workers %i cost %g total step norm %g" % (n_workers, cost, step_norm)
+        ok = ok and np.isfinite(cost) and np.isfinite(step_norm)
+    return ok
+
+if __name__ == "__main__":
+    logging.basicConfig()
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hyperparameters", help="YAML file from which to load hyperparameters")
+
+    args = parser.parse_args()
+
+    import main
+    hyperparameters = main.load_hyperparameters(args.hyperparameters)
+    sys.exit(0 if check_parallel(hyperparameters) else 1)
@@ -1,12 +1,65 @@
 # adapted from https://github.com/ballasn/LeViRe/blob/master/blocks/bricks/conv3d.py
-from theano.sandbox.cuda.dnn import dnn_conv3d, dnn_pool
-from theano.sandbox.cuda.blas import GpuCorr3dMM
+import operator
+import theano
+import theano.tensor as T
 
 from blocks.bricks import Initializable, Feedforward, Sequence
 from blocks.bricks.base import application, Brick, lazy
 from blocks.roles import add_role, FILTER, BIAS
 from blocks.utils import shared_floatx_nans
 
+import util
+
+def default_backend():
+    return "gpu" if util.cuda_enabled() else "cpu"
+
+def framewise_conv3d(input_, W, filter_size, step, padding, filter_shape=None):
+    """3D correlation on the CPU by way of 2D correlation.
+
+    the temporal taps of the filters are stacked as separate 2D filters
+    and applied to every frame in a single `conv2d`, after which the
+    responses to the taps are summed along time.  computes the same as
+    `GpuCorr3dMM` and has the same layout: `input_` is (batch, channel,
+    time, height, width) and `W` is (filter, channel, time, height,
+    width)."""
+    from theano.tensor.nnet import conv2d
+    n_taps, n_steps, n_pads = filter_size[0], step[0], padding[0]
+    if n_pads:
+        shape = input_.shape
+        padded = T.zeros((shape[0], shape[1], shape[2] + 2*n_pads, shape[3], shape[4]),
+                         dtype=input_.dtype)
+        input_ = T.set_subtensor(padded[:, :, n_pads:n_pads + shape[2]], input_)
+
+    batch_size, n_channels, n_frames, height, width = [input_.shape[i] for i in range(5)]
+    n_filters = W.shape[0]
+    frames = (input_.dimshuffle(0, 2, 1, 3, 4)
+              .reshape((batch_size * n_frames, n_channels, height, width)))
+    taps = (W.dimshuffle(2, 0, 1, 3, 4)
+            .reshape((n_taps * n_filters, n_channels) + tuple(filter_size[1:])))
+    if filter_shape is not None:
+        filter_shape = (n_taps * filter_shape[0],) + tuple(filter_shape[1:2]) + tuple(filter_size[1:])
+    responses = conv2d(frames, taps, filter_shape=filter_shape,
+                       border_mode=tuple(padding[1:]), subsample=tuple(step[1:]),
+                       filter_flip=False)
+    responses = responses.reshape((batch_size, n_frames, n_taps, n_filters,
+                                   responses.shape[2], responses.shape[3]))
+
+    # output frame t sums the response of frame t * n_steps + k to tap k
+    n_output_frames = (n_frames - n_taps) // n_steps + 1
+    output = reduce(operator.add, [
+        responses[:, k:k + n_steps * (n_output_frames - 1) + 1:n_steps, k]
+        for k in range(n_taps)])
+    return output.dimshuffle(0, 2, 1, 3, 4)
+
+def pool_2d(input_, pooling_size, step, backend):
+    # max pooling over the last two axes of a 4D tensor
+    if backend == "gpu":
+        from theano.sandbox.cuda.dnn import dnn_pool
+        return dnn_pool(img=input_, ws=tuple(pooling_size), stride=tuple(step))
+    else:
+        from theano.tensor.signal.pool import pool_2d
+        # positional because the keywords differ across theano versions
+        return pool_2d(input_, tuple(pooling_size), True, tuple(step))
 
 class Convolutional(Initializable):
     """Performs a 3D convolution.
@@ -38,12 +91,15 @@ class Convolutional(Initializable):
         Setting this to ``False`` will untie the biases, yielding a
         separate bias for every location at which the filter is applied.
         Defaults to ``False``.
+    backend : {'gpu', 'cpu'}, optional
+        Whether to use the cuda ops or `framewise_conv3d`. By default the
+        cuda ops are used if theano uses the GPU.
 
     """
     @lazy(allocation=['filter_size', 'num_filters', 'num_channels'])
     def __init__(self, filter_size, num_filters, num_channels, batch_size=None,
                  image_size=(None, None, None), step=(1, 1, 1), border_mode='valid',
-                 cudnn_impl=False, tied_biases=False, **kwargs):
+                 cudnn_impl=False, tied_biases=False, backend=None, **kwargs):
         super(Convolutional, self).__init__(**kwargs)
 
         self.filter_size = filter_size
@@ -55,6 +111,7 @@ class Convolutional(Initializable):
         self.border_mode = border_mode
         self.tied_biases = tied_biases
         self.cudnn_impl = cudnn_impl
+        self.backend = backend
 
     @property
     def padding(self):
@@ -124,11 +181,18 @@ class Convolutional(Initializable):
         else:
             W, = self.parameters
 
-        if self.cudnn_impl:
+        backend = self.backend or default_backend()
+        if backend == "cpu":
+            output = framewise_conv3d(
+                input_, W, self.filter_size, self.step, self.padding,
+                filter_shape=(self.num_filters, self.num_channels))
+        elif self.cudnn_impl:
+            from theano.sandbox.cuda.dnn import dnn_conv3d
             output = dnn_conv3d(input_, W,
                                 subsample=tuple(self.kernel_stride),
                                 border_mode=self.padding)
         else:
+            from theano.sandbox.cuda.blas import GpuCorr3dMM
             output = GpuCorr3dMM(subsample=tuple(self.step),
                                  pad=self.padding)(input_, W)
         if self.use_bias:
@@ -136,6 +200,7 @@ class Convolutional(Initializable):
                 output += b.dimshuffle('x', 0, 'x', 'x', 'x')
             else:
                 output += b.dimshuffle('x', 0, 1, 2, 3)
+        util.tag_profile_origin([input_], [output], "conv3d")
         return output
 
     def get_dim(self, name):
@@ -166,15 +231,20 @@ class MaxPooling(Initializable, Feedforward):
     input_dim : tuple, optional
         A tuple of integers representing the shape of the input. The last
         three dimensions will be used to calculate the output dimension.
+    backend : {'gpu', 'cpu'}, optional
+        Whether to use cudnn or theano's CPU pooling. By default cudnn is
+        used if theano uses the GPU.
 
     """
     @lazy(allocation=['pooling_size'])
-    def __init__(self, pooling_size, step=None, input_dim=None, **kwargs):
+    def __init__(self, pooling_size, step=None, input_dim=None, backend=None,
+                 **kwargs):
         super(MaxPooling, self).__init__(**kwargs)
 
         self.input_dim = input_dim
         self.pooling_size = pooling_size
         self.step = step
+        self.backend = backend
 
     @application(inputs=['input_'], outputs=['output'])
     def apply(self, input_):
@@ -197,18 +267,20 @@ class MaxPooling(Initializable, Feedforward):
         """
         if self.pooling_size == (1, 1, 1):
             return input_
+        backend = self.backend or default_backend()
         # Pooling on last two dimensions
         input__shape = input_.shape
         input_ = input_.reshape((input__shape[0], input__shape[1] * input__shape[2], input__shape[3], input__shape[4]))
-        p = dnn_pool(img=input_, ws=tuple(self.pooling_size[1:]), stride=tuple(self.step[1:]))
+        p = pool_2d(input_, self.pooling_size[1:], self.step[1:], backend)
         p_shape = p.shape
         p = p.reshape((p_shape[0], input__shape[1], input__shape[2], p_shape[2], p_shape[3]))
         # Pooling on first dimension
         p_shape = p.shape
         p = p.reshape((p_shape[0], p_shape[1], p_shape[2], p_shape[3] * p_shape[4]))
-        output = dnn_pool(img=p, ws=(self.pooling_size[0], 1), stride=(self.step[0], 1))
+        output = pool_2d(p, (self.pooling_size[0], 1), (self.step[0], 1), backend)
         output_shape = output.shape
         output = output.reshape((output_shape[0], output_shape[1], output_shape[2], p_shape[3] , p_shape[4]))
+        util.tag_profile_origin([input_], [output], "conv3d")
         return output
 
     def get_dim(self, name):
@@ -438,3 +510,40 @@ class Flattener(Brick):
     @application(inputs=['input_'], outputs=['output'])
     def apply(self, input_):
         return input_.flatten(ndim=2)
+
+
+if __name__ == "__main__":
+    # check the CPU convolution against conv3d2d and compare their speed
+    import time
+    import numpy as np
+    from theano.tensor.nnet.conv3d2d import conv3d
+
+    floatX = theano.config.floatX
+    rng = np.random.RandomState(1)
+    batch_size, n_channels, n_filters = 8, 16, 32
+    image_size, filter_size = (16, 32, 32), (3, 3, 3)
+    x_value = rng.normal(size=(batch_size, n_channels) + image_size).astype(floatX)
+    W_value = rng.normal(size=(n_filters, n_channels) + filter_size).astype(floatX)
+
+    x, W = T.TensorType(floatX, (False,) * 5)("x"), theano.shared(W_value, name="W")
+    framewise = framewise_conv3d(x, W, filter_size, (1, 1, 1), (0, 0, 0),
+                                 filter_shape=(n_filters, n_channels))
+    # conv3d2d wants time before channels and flips the filters
+    naive = conv3d(x.dimshuffle(0, 2, 1, 3, 4),
+                   W[:, :, ::-1, ::-1, ::-1].dimshuffle(0, 2, 1, 3, 4),
+                   signals_shape=(batch_size, image_size[0], n_channels) + image_size[1:],
+                   filters_shape=(n_filters, filter_size[0], n_channels) + filter_size[1:]
+                   ).dimshuffle(0, 2, 1, 3, 4)
+
+    results = {}
+    for name, output in [("framewise", framewise), ("conv3d2d", naive)]:
+        forward = theano.function([x], output)
+        backward = theano.function([x], T.grad(output.sum(), [x, W]))
+        results[name] = forward(x_value)
+        for label, function in [("forward", forward), ("forward+backward", backward)]:
+            function(x_value)
+            start = time.time()
+            for i in range(10):
+                function(x_value)
+            print "%s %s: %.1f ms" % (name, label, 100 * (time.time() - start))
+    print "max abs difference:", abs(results["framewise"] - results["conv3d2d"]).max()
@@ -1,4 +1 @@
-from op import TimCropperOp
-from grad import TimCropperGradOp
-
-from brick import Cropper, Gaussian
+from brick import Cropper, Gaussian, TabulatedGaussian
@@ -2,6 +2,7 @@ import math, logging
 import numpy as np
 import theano
 import theano.tensor as T
+from theano.ifelse import ifelse
 import util
 
 logger = logging.getLogger(__name__)
@@ -9,8 +10,6 @@ floatX = theano.config.floatX
 
 from blocks.bricks import Brick, application
 
-from op import TimCropperOp
-
 class Cropper(Brick):
     def __init__(self, patch_shape, kernel, hyperparameters, **kwargs):
         super(Cropper, self).__init__(**kwargs)
@@ -19,21 +18,40 @@ class Cropper(Brick):
         self.cutoff = hyperparameters["cutoff"]
         self.batched_window = hyperparameters["batched_window"]
         self.scan = hyperparameters["scan"]
+        # number of successively halved versions of the image to crop
+        # from when zoomed out
+        self.pyramid_levels = hyperparameters.get("pyramid_levels", 0)
+        # compute the gradient with respect to location and scale in
+        # closed form rather than by autodiff through the crop matrices
+        self.analytic_gradient = hyperparameters.get("analytic_gradient", False)
+        if self.analytic_gradient and type(kernel) is not Gaussian:
+            raise ValueError("analytic gradient is implemented only for the Gaussian kernel")
+        # images come concatenated along their first spatial axis rather
+        # than padded to the same shape; see transformers.RaggedShape
+        self.ragged = hyperparameters.get("ragged", False)
+        if self.ragged and (not self.batched_window or self.pyramid_levels):
+            raise ValueError("ragged images need batched_window and no pyramid")
         if not self.batched_window and not self.scan:
             logger.warning("using experimental cropper op")
             assert False # it's b0rken
+            # cuda; import only when used
+            from op import TimCropperOp
             self.cropop = TimCropperOp(patch_shape)
         self.n_spatial_dims = len(patch_shape)
 
-    def compute_crop_matrices(self, locations, scales, Is):
+    def compute_crop_matrices(self, locations, scales, Is, axes=None):
+        # `axes` are the spatial axes that the columns of `locations`
+        # and `scales` and the elements of `Is` correspond to
+        if axes is None:
+            axes = range(self.n_spatial_dims)
         Ws = []
-        for axis in xrange(self.n_spatial_dims):
+        for i, axis in enumerate(axes):
             n = T.cast(self.patch_shape[axis], floatX)
 
-            I = T.cast(Is[axis], floatX).dimshuffle('x', 0, 'x')    # (1, hardcrop_dim, 1)
+            I = T.cast(Is[i], floatX).dimshuffle('x', 0, 'x')       # (1, hardcrop_dim, 1)
             J = T.arange(n).dimshuffle('x', 'x', 0)                 # (1, 1, patch_dim)
-            location = locations[:, axis].dimshuffle(0, 'x', 'x')   # (batch_size, 1, 1)
-            scale    = scales   [:, axis].dimshuffle(0, 'x', 'x')   # (batch_size, 1, 1)
+            location = locations[:, i].dimshuffle(0, 'x', 'x')      # (batch_size, 1, 1)
+            scale    = scales   [:, i].dimshuffle(0, 'x', 'x')      # (batch_size, 1, 1)
 
             # map patch index into image index space
             J = (J - 0.5*n) / scale + location                      # (batch_size, 1, patch_dim)
@@ -44,8 +62,10 @@ class Cropper(Brick):
             Ws.append(self.kernel.density(dx2, scale))
         return Ws
 
-    def compute_hard_windows(self, image_shape, location, scale):
-        patch_shape = T.cast(self.patch_shape, floatX)
+    def compute_hard_windows(self, image_shape, location, scale, axes=None):
+        if axes is None:
+            axes = range(self.n_spatial_dims)
+        patch_shape = T.cast([self.patch_shape[axis] for axis in axes], floatX)
 
         # find topleft(front) and bottomright(back) corners for each patch
         a = location - 0.5 * (patch_shape / scale)
@@ -64,6 +84,116 @@ class Cropper(Brick):
     @application(inputs="image image_shape location scale".split(),
                  outputs="patch savings".split())
     def apply(self, image, image_shape, location, scale):
+        if self.pyramid_levels:
+            patch, savings = self.apply_pyramid(image, image_shape, location, scale)
+        else:
+            patch, savings = self.apply_level(image, image_shape, location, scale)
+        util.tag_profile_origin([image, image_shape, location, scale],
+                                [patch, savings], "cropper")
+        return patch, savings
+
+    def apply_multi(self, sources, location, scale):
+        """crop several images with the same glimpse, e.g. feature maps
+        of the same video at different layers.  `sources` is a list of
+        (image, image_shape, axes, resolution) where `axes` are the
+        spatial axes of the glimpse that the image has, in order, and
+        `resolution` is the number of image pixels per unit of
+        `location` along them.  the hard windows and crop matrices are
+        computed once per axis and resolution and shared by the images,
+        which must therefore have the same extent along those.  returns
+        lists of patches and savings, one per source."""
+        if not self.batched_window or self.ragged or self.pyramid_levels:
+            raise ValueError("multiple sources need batched_window, no ragged images and no pyramid")
+        if self.analytic_gradient:
+            # SeparableCropOp computes its crop matrices itself, so they
+            # can't be shared
+            raise ValueError("multiple sources don't support the analytic gradient")
+        axis_crops = dict()
+        patches, savingss = [], []
+        for image, image_shape, axes, resolution in sources:
+            windows, matrices = [], []
+            for i, axis in enumerate(axes):
+                key = (axis, resolution)
+                if key not in axis_crops:
+                    axis_crops[key] = self.compute_axis_crop(
+                        image_shape[:, i], location[:, axis], scale[:, axis],
+                        axis, resolution)
+                a, b, matrix = axis_crops[key]
+                windows.append(slice(a, b))
+                matrices.append(matrix)
+            patch = image[np.index_exp[:, :] + tuple(windows)]
+            for matrix in matrices:
+                patch = util.batched_tensordot(patch, matrix, [[2], [1]])
+            extents = T.stack([T.cast(window.stop - window.start, floatX)
+                               for window in windows])
+            savings = 1 - extents.prod() / image_shape.prod(axis=1)
+            util.tag_profile_origin([image, image_shape, location, scale],
+                                    [patch, savings], "cropper")
+            patches.append(patch)
+            savingss.append(savings)
+        return patches, savingss
+
+    def compute_axis_crop(self, image_shape, location, scale, axis, resolution):
+        # batched hard window and crop matrix along a single axis at the
+        # given resolution; see apply_level and apply_pyramid
+        if resolution != 1:
+            location = (location + 0.5) * resolution - 0.5
+            scale = scale * resolution
+        location = T.shape_padright(location)
+        scale = T.shape_padright(scale)
+        a, b = self.compute_hard_windows(T.shape_padright(image_shape),
+                                         location, scale, axes=[axis])
+        a = T.cast(T.floor(a), 'int16').min()
+        b = T.cast(T.ceil(b), 'int16').max()
+        slice_ = theano.gradient.disconnected_grad(T.arange(a, b))
+        matrix, = self.compute_crop_matrices(location, scale, [slice_], axes=[axis])
+        return a, b, matrix
+
+    def downsample(self, image):
+        # halve each spatial dimension by averaging pairs of pixels,
+        # dropping the last one if the dimension is odd
+        for axis in xrange(2, 2 + self.n_spatial_dims):
+            n = image.shape[axis] // 2
+            even = [slice(None)] * image.ndim
+            odd = [slice(None)] * image.ndim
+            even[axis] = slice(0, 2*n, 2)
+            odd[axis] = slice(1, 2*n, 2)
+            image = 0.5 * (image[tuple(even)] + image[tuple(odd)])
+        return image
+
+    def apply_pyramid(self, image, image_shape, location, scale):
+        # each level halves the resolution, so a glimpse with scale s
+        # sees 1/s image pixels per patch pixel at level 0 but only
+        # 2**-l/s at level l.  take the coarsest level at which no axis
+        # is undersampled, i.e. at which the scale is still at most one.
+        # the level is shared by the batch so that the windows can be
+        # batched; take the finest level that any example needs.  the
+        # level depends on the scale discretely; no gradient.
+        level = T.floor(-T.log2(scale.max(axis=1))).min()
+        level = theano.gradient.disconnected_grad(
+            T.clip(level, 0, self.pyramid_levels))
+
+        # level l pixel i averages level 0 pixels 2**l*i up to
+        # 2**l*(i+1) - 1
+        images = [image]
+        for l in xrange(self.pyramid_levels):
+            images.append(self.downsample(images[-1]))
+        results = []
+        for l, level_image in enumerate(images):
+            factor = 2.**l
+            results.append(self.apply_level(
+                level_image,
+                T.floor(image_shape / factor),
+                (location - 0.5*(factor - 1)) / factor,
+                scale * factor))
+
+        # evaluate only the chosen level
+        patch, savings = results[-1]
+        for l in reversed(xrange(self.pyramid_levels)):
+            patch, savings = ifelse(T.eq(level, l), results[l], [patch, savings])
+        return patch, savings
+
+    def apply_level(self, image, image_shape, location, scale):
         a, b = self.compute_hard_windows(image_shape, location, scale)
 
         if hasattr(self, "cropop"):
@@ -81,7 +211,8 @@ class Cropper(Brick):
                 a = a.min(axis=0, keepdims=True)
                 b = b.max(axis=0, keepdims=True)
 
-                patch = self.apply_inner(image, location, scale, a[0], b[0])
+                patch = self.apply_inner(image, location, scale, a[0], b[0],
+                                         image_shape=image_shape)
             elif self.scan:
                 def map_fn(image, a, b, location, scale):
                     # apply_inner expects a batch axis
@@ -101,19 +232,50 @@ class Cropper(Brick):
         savings = (1 - T.cast((b - a).prod(axis=1), floatX) / image_shape.prod(axis=1))
         return patch, savings
 
-    def apply_inner(self, image, location, scale, a, b):
+    def apply_inner(self, image, location, scale, a, b, image_shape=None):
         slices = [theano.gradient.disconnected_grad(T.arange(a[i], b[i]))
                   for i in xrange(self.n_spatial_dims)]
-        hardcrop = image[
-            np.index_exp[:, :] +
-            tuple(slice(a[i], b[i])
-                  for i in range(self.n_spatial_dims))]
+        if self.ragged:
+            hardcrop = self.ragged_hardcrop(image, image_shape, a, b)
+        else:
+            hardcrop = image[
+                np.index_exp[:, :] +
+                tuple(slice(a[i], b[i])
+                      for i in range(self.n_spatial_dims))]
+        if self.analytic_gradient:
+            from separable import SeparableCropOp
+            return SeparableCropOp(self.patch_shape)(hardcrop, location, scale, *slices)
         matrices = self.compute_crop_matrices(location, scale, slices)
         patch = hardcrop
         for axis, matrix in enumerate(matrices):
             patch = util.batched_tensordot(patch, matrix, [[2], [1]])
         return patch
 
+    def ragged_hardcrop(self, image, image_shape, a, b):
+        # `image` holds the examples one after the other along the first
+        # spatial axis, which comes first, i.e. (total_length, channels)
+        # + other spatial axes.  take the same window from each example
+        # and zero whatever lies beyond its own length, as if padded.
+        lengths = T.cast(image_shape[:, 0], "int64")
+        offsets = T.extra_ops.cumsum(lengths) - lengths
+        positions = T.arange(a[0], b[0])
+        valid = T.lt(positions.dimshuffle('x', 0), lengths.dimshuffle(0, 'x'))
+        # (batch_size, window_length); point the invalid ones anywhere
+        indices = T.switch(valid, offsets.dimshuffle(0, 'x') + positions.dimshuffle('x', 0), 0)
+        hardcrop = image[
+            np.index_exp[:, :] +
+            tuple(slice(a[i], b[i])
+                  for i in range(1, self.n_spatial_dims))]
+        hardcrop = hardcrop[indices.flatten()]
+        hardcrop = hardcrop.reshape(
+            T.concatenate([indices.shape, hardcrop.shape[1:]]),
+            ndim=hardcrop.ndim + 1)
+        # (batch_size, channels, window_length) + other spatial axes
+        hardcrop = hardcrop.dimshuffle(*([0, 2, 1] + list(range(3, hardcrop.ndim))))
+        mask = T.cast(valid, hardcrop.dtype).dimshuffle(
+            *([0, 'x', 1] + ['x'] * (self.n_spatial_dims - 1)))
+        return hardcrop * mask
+
 class Gaussian(object):
     def density(self, x2, scale):
         sigma = self.sigma(scale)
@@ -136,6 +298,34 @@ class Gaussian(object):
         # this isn't correct in multiple dimensions, but it's good enough
         return k * self.sigma(scale)
 
+class TabulatedGaussian(Gaussian):
+    """Gaussian that looks up the exponential in a table rather than
+    computing it.
+
+    the table holds exp(-v/2) on a regular grid of squared distances v
+    in units of sigma, up to `radius` sigmas, and is interpolated
+    linearly in between.  the derivative is that of the interpolant,
+    i.e. the tabulated slope.  the error is at most step**2/32 where
+    step is radius**2/resolution.  beyond `radius` the density is zero,
+    which matches the hard window if `radius` is the cropper's cutoff."""
+    def __init__(self, radius=3, resolution=1024):
+        self.radius = radius
+        self.resolution = resolution
+        self.step = radius**2 / float(resolution)
+        self.table = np.exp(-0.5 * self.step * np.arange(resolution + 1)).astype(floatX)
+
+    def density(self, x2, scale):
+        sigma = self.sigma(scale)
+        volume = T.sqrt(2*math.pi)*sigma
+        position = x2 / (sigma**2) / self.step
+        index = theano.gradient.disconnected_grad(
+            T.cast(T.clip(T.floor(position), 0, self.resolution - 1), "int64"))
+        fraction = position - index
+        table = T.constant(self.table)
+        exponential = (1 - fraction) * table[index] + fraction * table[index + 1]
+        exponential = T.switch(position < self.resolution, exponential, 0)
+        return exponential / volume
+
 
 if __name__ == "__main__":
     import numpy as np
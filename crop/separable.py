@@ -0,0 +1,138 @@
+import numpy as np
+import theano
+import theano.tensor as T
+from theano import Apply, Op
+
+# soft cropping with the Gaussian kernel, on the CPU, with a closed-form
+# gradient with respect to location and scale.  the backward pass needs
+# only the hard crop and recomputes the 1-D kernels, so none of the
+# (batch, window, patch) weight matrices or partially contracted crops
+# are kept around between forward and backward.
+
+def gaussian_matrices(I, location, scale, n):
+    """compute the crop matrix of one axis and its derivatives with
+    respect to location and scale, all of shape (batch, window, patch).
+    matches `Cropper.compute_crop_matrices` with `Gaussian`."""
+    I = I[np.newaxis, :, np.newaxis]
+    location = location[:, np.newaxis, np.newaxis]
+    scale = scale[:, np.newaxis, np.newaxis]
+    offset = np.arange(n)[np.newaxis, np.newaxis, :] - 0.5*n
+    d = I - (offset / scale + location)
+    # sigma is clamped for scales above one; see Gaussian.sigma
+    clamped = scale > 1
+    sigma = 0.5 / np.where(clamped, 1., scale)
+    dsigma_dscale = np.where(clamped, 0., -0.5 / scale**2)
+    w = np.exp(-0.5 * d**2 / sigma**2) / (np.sqrt(2*np.pi) * sigma)
+    # d depends on location and scale through the patch pixel position
+    dw_dd = -d / sigma**2 * w
+    dw_dlocation = -dw_dd
+    dw_dscale = (dw_dd * offset / scale**2 +
+                 w * (d**2 / sigma**3 - 1 / sigma) * dsigma_dscale)
+    return w, dw_dlocation, dw_dscale
+
+def contract(x, W):
+    # contract the first spatial axis of x with W, appending the patch
+    # axis; cf. util.batched_tensordot(x, W, [[2], [1]])
+    axes = "ijk"[:x.ndim - 2]
+    return np.einsum("bc%s,b%sz->bc%sz" % (axes, axes[0], axes[1:]), x, W)
+
+def crop(x, matrices):
+    for W in matrices:
+        x = contract(x, W)
+    return x
+
+class SeparableCropOp(Op):
+    """crop `patch_shape` patches from the hard crop `x` given the
+    location and scale in the hard crop's coordinates and the image
+    indices `Is` covered by the hard crop along each spatial axis."""
+    __props__ = ("patch_shape",)
+
+    def __init__(self, patch_shape):
+        self.patch_shape = tuple(patch_shape)
+
+    def make_node(self, x, location, scale, *Is):
+        x, location, scale = map(T.as_tensor_variable, (x, location, scale))
+        Is = list(map(T.as_tensor_variable, Is))
+        if x.ndim != 2 + len(self.patch_shape) or len(Is) != len(self.patch_shape):
+            raise TypeError("expected %i spatial dimensions" % len(self.patch_shape))
+        if location.ndim != 2 or scale.ndim != 2 or any(I.ndim != 1 for I in Is):
+            raise TypeError("expected location and scale matrices and index vectors")
+        output_type = T.TensorType(dtype=x.dtype, broadcastable=x.broadcastable[:2] +
+                                   (False,) * len(self.patch_shape))
+        return Apply(self, [x, location, scale] + Is, [output_type()])
+
+    def infer_shape(self, node, shapes):
+        return [tuple(shapes[0][:2]) + self.patch_shape]
+
+    def perform(self, node, inputs, output_storage):
+        x, location, scale = inputs[:3]
+        matrices = [gaussian_matrices(I, location[:, axis], scale[:, axis], n)[0]
+                    for axis, (I, n) in enumerate(zip(inputs[3:], self.patch_shape))]
+        output_storage[0][0] = crop(x, matrices).astype(node.outputs[0].dtype)
+
+    def grad(self, inputs, output_grads):
+        x, location, scale = inputs[:3]
+        dpatch, = output_grads
+        dlocation, dscale = SeparableCropGradOp(self.patch_shape)(
+            x, location, scale, dpatch, *inputs[3:])
+        return ([theano.gradient.grad_not_implemented(
+                    self, 0, x, "the hard crop is assumed to be data"),
+                 dlocation, dscale] +
+                [theano.gradient.disconnected_type() for I in inputs[3:]])
+
+    def connection_pattern(self, node):
+        return [[True], [True], [True]] + [[False]] * len(self.patch_shape)
+
+class SeparableCropGradOp(Op):
+    """gradient of the cost with respect to location and scale given its
+    gradient `dpatch` with respect to the patch.  the patch is linear in
+    each axis' crop matrix, so its derivative with respect to the
+    location or scale along an axis is the crop with that axis' matrix
+    replaced by its derivative."""
+    __props__ = ("patch_shape",)
+
+    def __init__(self, patch_shape):
+        self.patch_shape = tuple(patch_shape)
+
+    def make_node(self, x, location, scale, dpatch, *Is):
+        inputs = list(map(T.as_tensor_variable, (x, location, scale, dpatch) + Is))
+        return Apply(self, inputs, [inputs[1].type(), inputs[2].type()])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[1], shapes[2]]
+
+    def perform(self, node, inputs, output_storage):
+        x, location, scale, dpatch = inputs[:4]
+        matrices = [gaussian_matrices(I, location[:, axis], scale[:, axis], n)
+                    for axis, (I, n) in enumerate(zip(inputs[4:], self.patch_shape))]
+        dlocation = np.empty_like(location)
+        dscale = np.empty_like(scale)
+        reduction_axes = tuple(range(1, dpatch.ndim))
+        for axis in range(len(self.patch_shape)):
+            for result, which in ((dlocation, 1), (dscale, 2)):
+                # contract with the dpatch first along the other axes
+                # would be cheaper, but the crops are small
+                dpatch_daxis = crop(x, [matrix[which] if i == axis else matrix[0]
+                                        for i, matrix in enumerate(matrices)])
+                result[:, axis] = (dpatch * dpatch_daxis).sum(axis=reduction_axes)
+        output_storage[0][0] = dlocation
+        output_storage[1][0] = dscale
+
+    def grad(self, inputs, output_grads):
+        return [theano.gradient.grad_not_implemented(self, i, input)
+                for i, input in enumerate(inputs)]
+
+if __name__ == "__main__":
+    # check the analytic gradient numerically
+    floatX = theano.config.floatX
+    rng = np.random.RandomState(1)
+    patch_shape = (4, 5)
+    x = rng.uniform(size=(2, 3, 10, 12)).astype(floatX)
+    Is = [np.arange(10).astype(floatX), np.arange(12).astype(floatX)]
+    location = rng.uniform(3, 7, size=(2, 2)).astype(floatX)
+    # stay away from the kink in sigma at scale one
+    scale = rng.uniform(0.4, 0.9, size=(2, 2)).astype(floatX)
+    op = SeparableCropOp(patch_shape)
+    theano.gradient.verify_grad(lambda location, scale: op(x, location, scale, *Is),
+                                [location, scale], rng=rng)
+    print "gradient ok"
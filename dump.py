@@ -1,12 +1,14 @@
-import tempfile, os.path, cPickle, zipfile, shutil
+import sys, copy, tempfile, os.path, cPickle, zipfile, logging, threading
+from cStringIO import StringIO
 from collections import OrderedDict
 import numpy as np
 import theano
 from blocks.extensions import SimpleExtension, Printing
 from blocks.serialization import secure_dump
-import blocks.config
 import util
 
+logger = logging.getLogger(__name__)
+
 class PrintingTo(Printing):
     def __init__(self, path, **kwargs):
         super(PrintingTo, self).__init__(**kwargs)
@@ -30,6 +32,64 @@ class DumpLog(SimpleExtension):
     def do(self, callback_name, *args):
         secure_dump(self.main_loop.log, self.path, use_cpickle=True)
 
+# key of the records in an AppendLog file that hold the log status
+STATUS_KEY = "status"
+
+class AppendLog(SimpleExtension):
+    """append the log rows added since the previous dump to a file of
+    consecutive pickles, so each dump costs O(new rows) rather than
+    O(history). use `load_log` to reconstruct the log."""
+    def __init__(self, path, **kwargs):
+        kwargs.setdefault("after_training", True)
+        super(AppendLog, self).__init__(**kwargs)
+        self.path = path
+        # the row at the last dumped iteration may have been amended
+        # since by later callbacks, so it is written again on the next
+        # dump; later records override earlier ones when loading.
+        self.last_iteration = 0
+        with open(self.path, "w") as f:
+            f.truncate(0)
+
+    def do(self, callback_name, *args):
+        log = self.main_loop.log
+        iterations_done = log.status["iterations_done"]
+        with open(self.path, "ab") as f:
+            for iteration in xrange(self.last_iteration, iterations_done + 1):
+                # don't use log[iteration], the log is a defaultdict
+                if iteration in log:
+                    cPickle.dump((iteration, dict(log[iteration])), f,
+                                 cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump((STATUS_KEY, dict(log.status)), f,
+                         cPickle.HIGHEST_PROTOCOL)
+        self.last_iteration = iterations_done
+
+def load_log(path, iterations_done=None):
+    """reconstruct a TrainingLog from a file written by AppendLog.
+
+    if `iterations_done` is given, the log is reconstructed as it was
+    when that many iterations were done, e.g. to match a checkpoint
+    that was taken before the last rows were written."""
+    from blocks.log import TrainingLog
+    log = TrainingLog()
+    with open(path, "rb") as f:
+        while True:
+            try:
+                key, value = cPickle.load(f)
+            except EOFError:
+                break
+            except (cPickle.UnpicklingError, ValueError) as e:
+                # a torn record at the end due to a crash mid-dump
+                logger.warning("stopped reading log %s at corrupt record: %s"
+                               % (path, e))
+                break
+            if key == STATUS_KEY:
+                if (iterations_done is None or
+                        value["iterations_done"] <= iterations_done):
+                    log.status.update(value)
+            elif iterations_done is None or key <= iterations_done:
+                log[key].update(value)
+    return log
+
 class DumpGraph(SimpleExtension):
     def __init__(self, path, **kwargs):
         kwargs["after_batch"] = True
@@ -45,59 +105,143 @@ class DumpGraph(SimpleExtension):
                 with open(self.path, "w") as f:
                     theano.printing.debugprint(self.main_loop.algorithm._function, file=f)
 
-class DumpBest(SimpleExtension):
+class Writer(threading.Thread):
+    """call `function(*args)` on a separate thread; any exception it
+    raises is reraised on `join`"""
+    def __init__(self, function, *args):
+        super(Writer, self).__init__(name="dump writer")
+        self.function = function
+        self.args = args
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.function(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def join(self):
+        super(Writer, self).join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+class DumpMainLoop(SimpleExtension):
+    """base for extensions that dump the main loop by `dump_main_loop`.
+
+    if `background`, only the snapshot is taken on the training thread;
+    serializing and writing the snapshot happen on a background thread
+    while training continues.  at most one write is in flight at a
+    time, and the file is replaced atomically so a crash leaves either
+    the previous or the new dump."""
+    def __init__(self, save_path, background=False, **kwargs):
+        super(DumpMainLoop, self).__init__(**kwargs)
+        self.save_path = save_path
+        self.background = background
+        self.writer = None
+
+    def dump(self):
+        snapshot = snapshot_main_loop(self.main_loop)
+        # wait for the previous write so they land in order
+        self.join()
+        if self.background:
+            self.writer = Writer(dump_snapshot, snapshot, self.save_path)
+            self.writer.start()
+        else:
+            dump_snapshot(snapshot, self.save_path)
+
+    def join(self):
+        if self.writer is not None:
+            writer, self.writer = self.writer, None
+            writer.join()
+
+    def dispatch(self, callback_name, *args):
+        super(DumpMainLoop, self).dispatch(callback_name, *args)
+        if callback_name == "after_training":
+            self.join()
+
+    def __getstate__(self):
+        # threads don't pickle; the main loop may be pickled by Checkpoint
+        state = dict(self.__dict__)
+        state["writer"] = None
+        return state
+
+class DumpBest(DumpMainLoop):
     """dump if the `notification_name` record is present"""
     def __init__(self, notification_name, save_path, **kwargs):
         self.notification_name = notification_name
-        self.save_path = save_path
         kwargs.setdefault("after_epoch", True)
-        super(DumpBest, self).__init__(**kwargs)
+        super(DumpBest, self).__init__(save_path, **kwargs)
 
     def do(self, which_callback, *args):
         if self.notification_name in self.main_loop.log.current_row:
-            secure_dump(self.main_loop, self.save_path, dump_main_loop)
+            self.dump()
 
-class LightCheckpoint(SimpleExtension):
+class LightCheckpoint(DumpMainLoop):
     def __init__(self, save_path, **kwargs):
         kwargs.setdefault("after_epoch", True)
-        super(LightCheckpoint, self).__init__(**kwargs)
-        self.save_path = save_path
+        super(LightCheckpoint, self).__init__(save_path, **kwargs)
 
     def do(self, which_callback, *args, **kwargs):
-        secure_dump(self.main_loop, self.save_path, dump_main_loop)
+        self.dump()
 
 PARAMETER_FILENAME = "parameters.npz"
 LOG_FILENAME = "log.pkl"
 
 def dump_main_loop(main_loop, path):
     # dump a zip file with parameters.npz and log.pkl
+    dump_snapshot(snapshot_main_loop(main_loop), path)
+
+def snapshot_main_loop(main_loop):
+    # copy out everything dump_snapshot needs, so that the main loop
+    # can go on changing while the snapshot is written
+    return dict(
+        # get_value copies
+        parameters=main_loop.model.get_parameter_values(),
+        # pickling the log is O(history), so that is left to
+        # dump_snapshot
+        log=copy_log(main_loop.log))
+
+def copy_log(log):
+    # copy the rows and the status, which are amended as training goes
+    # on, but not the values in them, which are only ever replaced
+    snapshot = type(log).__new__(type(log))
+    snapshot.__dict__.update(log.__dict__)
+    snapshot.default_factory = log.default_factory
+    snapshot.status = copy.deepcopy(log.status)
+    for iteration, row in log.items():
+        snapshot[iteration] = dict(row)
+    return snapshot
+
+def dump_snapshot(snapshot, path):
+    # write to a temporary file next to `path` and rename it into place,
+    # which is atomic on posix.  the members are written straight into
+    # the archive rather than staged on disk.
     try:
-        temp_dir = tempfile.mkdtemp(dir=blocks.config.config.temp_dir)
-        parameter_path = os.path.join(temp_dir, PARAMETER_FILENAME)
-        log_path = os.path.join(temp_dir, LOG_FILENAME)
-        dump_model_parameters(main_loop.model, parameter_path)
-        cPickle.dump(main_loop.log, open(log_path, "w"))
-        with zipfile.ZipFile(path, "w") as archive:
-            archive.write(parameter_path, PARAMETER_FILENAME)
-            archive.write(log_path, LOG_FILENAME)
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=os.path.basename(path) + ".")
+        with os.fdopen(handle, "wb") as f:
+            with zipfile.ZipFile(f, "w", allowZip64=True) as archive:
+                parameters = StringIO()
+                np.savez(parameters, **snapshot["parameters"])
+                archive.writestr(PARAMETER_FILENAME, parameters.getvalue())
+                del parameters
+                archive.writestr(LOG_FILENAME, cPickle.dumps(
+                    snapshot["log"], cPickle.HIGHEST_PROTOCOL))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
     finally:
-        if "temp_dir" in locals():
-            shutil.rmtree(temp_dir)
+        if "temp_path" in locals() and os.path.exists(temp_path):
+            os.remove(temp_path)
 
 def load_main_loop(main_loop, path):
     # load parameters.npz and log.pkl from a zip file
-    try:
-        temp_dir = tempfile.mkdtemp(dir=blocks.config.config.temp_dir)
-        with zipfile.ZipFile(path, "r") as archive:
-            archive.extractall(temp_dir)
-            load_model_parameters(
-                main_loop.model,
-                os.path.join(temp_dir, PARAMETER_FILENAME))
-            main_loop.log = cPickle.load(open(
-                os.path.join(temp_dir, LOG_FILENAME)))
-    finally:
-        if "temp_dir" in locals():
-            shutil.rmtree(temp_dir)
+    with zipfile.ZipFile(path, "r") as archive:
+        load_model_parameters(
+            main_loop.model,
+            StringIO(archive.read(PARAMETER_FILENAME)))
+        main_loop.log = cPickle.load(archive.open(LOG_FILENAME))
     # ensure the algorithm and extensions will be initialized
     main_loop.log.status["training_started"] = False
 
@@ -106,3 +250,12 @@ def dump_model_parameters(model, file):
 
 def load_model_parameters(model, file):
     model.set_parameter_values(np.load(file))
+
+if __name__ == "__main__":
+    # convert a file written by AppendLog to a pickled TrainingLog
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rows_path", help="file written by AppendLog")
+    parser.add_argument("log_path", help="where to pickle the TrainingLog")
+    args = parser.parse_args()
+    secure_dump(load_log(args.rows_path), args.log_path, use_cpickle=True)
@@ -1,5 +1,6 @@
 from collections import OrderedDict
 import numpy
+import theano
 from theano import tensor
 from theano.ifelse import ifelse
 from blocks.utils import shared_floatx
@@ -7,18 +8,54 @@ from blocks.theano_expressions import l2_norm
 from blocks.algorithms import StepRule
 
 class Compressor(StepRule):
-    def __init__(self, initial_threshold=1., window_width=257):
+    """push down steps whose norm exceeds the median of recent step norms.
+
+    with `median_estimator="exact"`, the median is computed over a ring
+    buffer holding the last `window_width` norms.  with "approximate",
+    a running estimate is nudged up or down by a factor of
+    `exp(approximate_rate)` toward each new norm, which tracks the median
+    in constant time and memory."""
+    def __init__(self, initial_threshold=1., window_width=257,
+                 median_estimator="exact", approximate_rate=0.05):
         self.window_width = window_width
-        self.window = shared_floatx(
-            initial_threshold *
-            numpy.zeros((1,)),
-            "window")
+        self.median_estimator = median_estimator
+        self.approximate_rate = approximate_rate
+        if median_estimator == "exact":
+            self.window = shared_floatx(
+                initial_threshold *
+                numpy.zeros((window_width,)),
+                "window")
+            # position of the oldest norm, which is replaced next
+            self.index = theano.shared(numpy.array(1, dtype="int64"), "index")
+            # number of norms in the window; initially the single zero
+            self.count = theano.shared(numpy.array(1, dtype="int64"), "count")
+        elif median_estimator == "approximate":
+            self.estimate = shared_floatx(initial_threshold * 0., "estimate")
+        else:
+            raise ValueError("unknown median estimator %s" % median_estimator)
 
-    def compute_steps(self, previous_steps):
-        def median(window):
-            return tensor.sort(window)[self.window.shape[0] / 2]
+    def compute_median(self):
+        if self.median_estimator == "exact":
+            return tensor.sort(self.window[:self.count])[self.count // 2]
+        else:
+            return self.estimate
 
-        self.median = median(self.window)
+    def update_median(self, norm):
+        if self.median_estimator == "exact":
+            return [(self.window, tensor.set_subtensor(self.window[self.index], norm)),
+                    (self.index, (self.index + 1) % self.window_width),
+                    (self.count, tensor.minimum(self.count + 1, self.window_width))]
+        else:
+            # the estimate starts out at zero; take the first norm as is
+            estimate = tensor.switch(
+                tensor.eq(self.estimate, 0),
+                norm,
+                self.estimate * tensor.exp(self.approximate_rate *
+                                           tensor.sgn(norm - self.estimate)))
+            return [(self.estimate, tensor.cast(estimate, self.estimate.dtype))]
+
+    def compute_steps(self, previous_steps):
+        self.median = self.compute_median()
 
         # allow within 1 median absolute deviation
         #self.deviation = median(abs(self.window - self.median))
@@ -36,23 +73,218 @@ class Compressor(StepRule):
                           self.norm ** (1 / self.ratio) / self.norm))
         self.newnorm = multiplier * self.norm
 
-        newwindow = tensor.concatenate([
-            tensor.shape_padleft(self.norm),
-            self.window[:(self.window_width - 1)]
-        ], axis=0)
-
-        # let the norm affect the median only if it was acceptable
-        # or if the window hasn't been fully populated yet
-        #newwindow = ifelse(
-        #    acceptable + (self.window.shape[0] < self.window_width),
-        #    tensor.concatenate([
-        #        tensor.shape_padleft(self.norm),
-        #        self.window[:(self.window_width - 1)]],
-        #        axis=0),
-        #    self.window)
+        # NOTE: the norm is allowed to affect the median whether or not
+        # it was acceptable
+        updates = self.update_median(self.norm)
 
         steps = OrderedDict(
             (parameter, multiplier * step)
             for parameter, step in previous_steps.items())
-        updates = [(self.window, newwindow)]
         return steps, updates
+
+from blocks.extensions import SimpleExtension
+class ProfileWindow(SimpleExtension):
+    """profile the training function over the first `n_batches` batches
+    of every `every_n_epochs`th epoch, and the monitoring functions of
+    `monitors` at the end of that epoch.
+
+    the profiler summaries are written to `<save_prefix>_epoch<i>.txt`,
+    each preceded by a breakdown of time by origin as tagged by
+    `util.tag_profile_origin`.  should come after `monitors` in the list
+    of extensions."""
+    def __init__(self, save_prefix, every_n_epochs, n_batches=10,
+                 monitors=(), n_ops_to_print=20, n_apply_to_print=20,
+                 **kwargs):
+        kwargs.setdefault("before_epoch", True)
+        kwargs.setdefault("after_batch", True)
+        kwargs.setdefault("after_epoch", True)
+        super(ProfileWindow, self).__init__(**kwargs)
+        self.save_prefix = save_prefix
+        self.every_n_epochs = every_n_epochs
+        self.n_batches = n_batches
+        self.monitors = list(monitors)
+        self.n_ops_to_print = n_ops_to_print
+        self.n_apply_to_print = n_apply_to_print
+        # profiled versions of the functions, compiled on first use
+        self.training_function = None
+        self.accumulate_functions = {}
+        self.window = None
+
+    def __getstate__(self):
+        # compiled functions with profiles don't pickle
+        state = dict(self.__dict__)
+        state["training_function"] = None
+        state["accumulate_functions"] = {}
+        state["window"] = None
+        return state
+
+    def do(self, which_callback, *args):
+        if which_callback == "before_epoch":
+            epoch = self.main_loop.log.status["epochs_done"]
+            if epoch % self.every_n_epochs == 0:
+                self.start(epoch)
+        elif self.window is None:
+            return
+        elif which_callback == "after_batch":
+            self.window["batches"] += 1
+            if self.window["batches"] >= self.n_batches:
+                self.stop_training()
+        elif which_callback == "after_epoch":
+            self.stop_training()
+            self.stop_monitors()
+            self.write()
+            self.window = None
+
+    def start(self, epoch):
+        from theano.compile import profiling
+        from theano.compile.profiling import ProfileStats
+        algorithm = self.main_loop.algorithm
+        if self.training_function is None:
+            # the linker records per-node times only if the function is
+            # compiled with a profile
+            profile = ProfileStats(atexit_print=False)
+            if hasattr(algorithm, "compile_shard_function"):
+                # data-parallel; profile the main process's shard
+                self.training_function = algorithm.compile_shard_function(
+                    profile=profile)
+            else:
+                kwargs = dict(algorithm.theano_func_kwargs, profile=profile)
+                self.training_function = theano.function(
+                    algorithm.inputs, [], updates=algorithm.updates, **kwargs)
+        self.window = dict(epoch=epoch, batches=0, profiles=[],
+                           training_function=algorithm._function,
+                           accumulate_functions={})
+        self.training_function.profile = ProfileStats(atexit_print=False)
+        self.window["profiles"].append(("training", self.training_function.profile))
+        algorithm._function = self.training_function
+
+        for monitor in self.monitors:
+            evaluator = monitor._evaluator
+            if monitor not in self.accumulate_functions:
+                # `_compile` replaces all of the evaluator's functions,
+                # and the functions it compiles with config.profile
+                # would print their profiles at exit
+                state = dict(evaluator.__dict__)
+                n_registered = len(profiling._atexit_print_list)
+                profile = theano.config.profile
+                theano.config.profile = True
+                try:
+                    evaluator._compile()
+                finally:
+                    theano.config.profile = profile
+                    del profiling._atexit_print_list[n_registered:]
+                self.accumulate_functions[monitor] = evaluator._accumulate_fun
+                evaluator.__dict__.update(state)
+            function = self.accumulate_functions[monitor]
+            if function is None:
+                continue
+            function.profile = ProfileStats(atexit_print=False)
+            self.window["profiles"].append(("%s monitoring" % monitor.prefix, function.profile))
+            self.window["accumulate_functions"][monitor] = evaluator._accumulate_fun
+            evaluator._accumulate_fun = function
+
+    def stop_training(self):
+        if "training_function" in self.window:
+            self.main_loop.algorithm._function = self.window.pop("training_function")
+
+    def stop_monitors(self):
+        for monitor, function in self.window["accumulate_functions"].items():
+            monitor._evaluator._accumulate_fun = function
+        self.window["accumulate_functions"] = {}
+
+    def write(self):
+        import util
+        from tabulate import tabulate
+        path = "%s_epoch%i.txt" % (self.save_prefix, self.window["epoch"])
+        with open(path, "w") as f:
+            for name, profile in self.window["profiles"]:
+                f.write("%s\n%s\n" % (name, "=" * len(name)))
+                seconds_by_origin = OrderedDict()
+                for key, seconds in profile.apply_time.items():
+                    # keys are (fgraph, node) in newer theano
+                    node = key[1] if isinstance(key, tuple) else key
+                    origin = util.get_profile_origin(node)
+                    seconds_by_origin[origin] = seconds_by_origin.get(origin, 0.) + seconds
+                total = sum(seconds_by_origin.values()) or 1.
+                f.write(tabulate(
+                    [(origin, seconds, 100 * seconds / total)
+                     for origin, seconds in sorted(seconds_by_origin.items(),
+                                                   key=lambda item: -item[1])],
+                    headers="origin seconds %".split()))
+                f.write("\n\n")
+                if profile.fct_callcount:
+                    profile.summary(file=f,
+                                    n_ops_to_print=self.n_ops_to_print,
+                                    n_apply_to_print=self.n_apply_to_print)
+                f.write("\n")
+
+class PipelineMonitoring(SimpleExtension):
+    """record the time spent waiting for training data since the last
+    record, and per stage of the training data pipeline the time spent
+    in the stage itself and the batch size in kilobytes.  the stream must
+    be instrumented as in tasks.Classification.get_stream."""
+    def __init__(self, **kwargs):
+        kwargs.setdefault("after_epoch", True)
+        super(PipelineMonitoring, self).__init__(**kwargs)
+
+    def do(self, which_callback, *args):
+        import transformers
+        stats = transformers.get_pipeline_stats(self.main_loop.data_stream)
+        if not stats:
+            return
+        current_row = self.main_loop.log.current_row
+        for key, value in transformers.summarize_pipeline_stats(stats).items():
+            current_row["data_%s" % key] = value
+        transformers.reset_pipeline_stats(stats)
+
+class StartupTimeline(SimpleExtension):
+    """add the startup phases that happen within the main loop, i.e.
+    compiling the training function, the other extensions' callbacks
+    before the first epoch (mainly monitoring) and processing the first
+    batch, to `timeline`, then print its report and save it to `path`.
+    should come last in the list of extensions."""
+    def __init__(self, timeline, path, **kwargs):
+        kwargs.setdefault("before_training", True)
+        kwargs.setdefault("before_epoch", True)
+        kwargs.setdefault("after_batch", True)
+        super(StartupTimeline, self).__init__(**kwargs)
+        self.timeline = timeline
+        self.path = path
+        self.done = False
+
+    def do(self, which_callback, *args):
+        if self.done:
+            return
+        if which_callback == "before_training":
+            # the main loop initializes the algorithm right after the
+            # before_training callbacks; intercept that to time it alone.
+            # the algorithm may have its own `initialize` already (see
+            # sweep.py).
+            algorithm = self.main_loop.algorithm
+            self.overridden_initialize = algorithm.__dict__.get("initialize")
+            algorithm.initialize = self.timed_initialize
+        elif which_callback == "before_epoch":
+            self.timeline.end()
+            self.timeline.begin("first batch")
+        elif which_callback == "after_batch":
+            self.timeline.end()
+            self.done = True
+            report = self.timeline.report()
+            print "startup timeline:"
+            print report
+            with open(self.path, "w") as f:
+                f.write(report)
+                f.write("\n")
+
+    def timed_initialize(self):
+        algorithm = self.main_loop.algorithm
+        # restore before anything gets pickled
+        if self.overridden_initialize is None:
+            del algorithm.initialize
+        else:
+            algorithm.initialize = self.overridden_initialize
+        del self.overridden_initialize
+        with self.timeline.phase("compile training function"):
+            algorithm.initialize()
+        # ends in our own before_epoch callback, which comes last
+        self.timeline.begin("initial monitoring")
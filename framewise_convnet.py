@@ -124,7 +124,9 @@ def prepare_mode(mode, outputs, emitter, hyperparameters, **kwargs):
 
 @util.checkargs
 def construct_graphs(task, video_shape, hyperparameters, **kwargs):
-    x, x_shape, y = task.get_variables()
+    x_stored, x_shape, y = task.get_variables()
+    # the features may be stored at reduced precision
+    x = task.upcast(x_stored)
 
     convnet = construct_model(task=task, **hyperparameters)
     convnet.initialize()
@@ -148,6 +150,8 @@ def construct_graphs(task, video_shape, hyperparameters, **kwargs):
     outputs_by_name = OrderedDict()
     for key in "x x_shape cost".split():
         outputs_by_name[key] = locals()[key]
+    # feed the data as stored
+    outputs_by_name["x"] = x_stored
     for key in task.monitor_outputs():
         outputs_by_name[key] = costs[key]
     outputs = list(outputs_by_name.values())
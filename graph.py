@@ -1,4 +1,5 @@
 import logging, numbers
+from collections import OrderedDict
 import theano
 import util
 
@@ -135,3 +136,177 @@ class ConstantTransform(object):
 
     def __call__(self, x, **hyperparameters):
         return self.replacement
+
+class FoldedBatchNormalizationTransform(object):
+    """fold an inference-mode batch normalization into the weights of
+    the preceding linear or convolutional layer.
+
+    the normalized variable is found among the ancestors of the batch
+    normalization output by its `original_id`.  the nearest weight or
+    filter parameter it depends on is scaled by the brick's folded scale
+    (along its output axis) and the folded shift is added to the result.
+    if there is no unique such parameter, the batch normalization is
+    left alone and will be handled by population_normalization."""
+    def __init__(self, brick, input_):
+        self.brick = brick
+        tag_with_id(input_)
+        self.input_id = input_.tag.original_id
+
+    def __str__(self):
+        return "fold(%s)" % self.brick.name
+
+    def __call__(self, output, **hyperparameters):
+        input_ = util.the([var for var in theano.gof.graph.ancestors([output])
+                           if getattr(var.tag, "original_id", None) == self.input_id])
+        weight, depth = self.find_weight(input_)
+        if weight is None:
+            logger.warning("not folding %s: no unique weight found for %s"
+                           % (self.brick.name, input_))
+            return output
+        scale, shift = self.brick.get_folded_scale_shift()
+        # linear weights are (input_dim, output_dim) and broadcast with
+        # scale as is; convolution filters are (num_filters,
+        # num_channels) + filter_size
+        if weight.ndim != 2:
+            scale = scale.dimshuffle(*([1, 0] + list(range(2, scale.ndim))))
+        # rebuild only the nodes between the weight and the input.  the
+        # weight is shared with other uses (e.g. earlier glimpses, which
+        # may have been folded already) further up the graph, which must
+        # be left alone.
+        folded_input = self.substitute(input_, weight, weight * scale, depth)
+        return folded_input + shift
+
+    def substitute(self, variable, old, new, depth):
+        # replace `old`, which is at most `depth` levels up from
+        # `variable`, by `new`
+        if variable is old:
+            return new
+        if depth == 0 or variable.owner is None:
+            return variable
+        inputs = [self.substitute(input, old, new, depth - 1)
+                  for input in variable.owner.inputs]
+        if all(a is b for a, b in zip(inputs, variable.owner.inputs)):
+            return variable
+        node = variable.owner.clone_with_new_inputs(inputs)
+        return node.outputs[variable.owner.outputs.index(variable)]
+
+    def find_weight(self, variable):
+        from blocks.roles import has_roles, WEIGHT, FILTER
+        # breadth-first, stopping at the first level that has weights.
+        # returns the weight and its depth.
+        frontier = [variable]
+        depth = 0
+        while frontier:
+            weights = util.dedup([var for var in frontier
+                                  if isinstance(var, theano.compile.SharedVariable)
+                                  and has_roles(var, [WEIGHT, FILTER])])
+            if weights:
+                return (weights[0] if len(weights) == 1 else None), depth
+            frontier = [input for var in frontier if var.owner
+                        for input in var.owner.inputs]
+            depth += 1
+        return None, depth
+
+def is_random(node):
+    # random number generators carry their state in a shared variable
+    # that is updated by default
+    return any(hasattr(input, "default_update") for input in node.inputs)
+
+class Rematerialized(theano.OpFromGraph):
+    """OpFromGraph that computes all gradients in a single op, so that
+    the forward computation is repeated only once during backprop.  the
+    gradient is computed only with respect to the inputs marked as
+    `differentiable`; the others are treated as disconnected."""
+    def __init__(self, inputs, outputs, differentiable, **kwargs):
+        super(Rematerialized, self).__init__(inputs, outputs, **kwargs)
+        # keep our own references; OpFromGraph's attributes differ
+        # between theano versions
+        self.rematerialized_inputs = inputs
+        self.rematerialized_outputs = outputs
+        self.differentiable = [d and input.dtype in theano.tensor.float_dtypes
+                               for input, d in util.equizip(inputs, differentiable)]
+        self.gradient_op = None
+
+    def connection_pattern(self, node):
+        return [[d] * len(node.outputs) for d in self.differentiable]
+
+    def grad(self, inputs, output_grads):
+        differentiable = self.differentiable
+        if self.gradient_op is None:
+            known_grads = [output.type() for output in self.rematerialized_outputs]
+            gradients = theano.grad(
+                None, known_grads=OrderedDict(util.equizip(
+                    self.rematerialized_outputs, known_grads)),
+                wrt=[input for input, d in util.equizip(
+                    self.rematerialized_inputs, differentiable) if d],
+                disconnected_inputs="ignore", return_disconnected="zero")
+            self.gradient_op = theano.OpFromGraph(
+                self.rematerialized_inputs + known_grads, gradients,
+                on_unused_input="ignore")
+        gradients = self.gradient_op(*(list(inputs) + list(output_grads)))
+        if not isinstance(gradients, (list, tuple)):
+            gradients = [gradients]
+        gradients = iter(gradients)
+        return [next(gradients) if d else theano.gradient.DisconnectedType()()
+                for d in differentiable]
+
+def rematerialize(output, boundary):
+    """replace `output` by an op that computes it from the `boundary`
+    variables and whatever else it needs that doesn't depend on them.
+    the op's intermediate results are not kept for backprop but
+    recomputed.  random numbers are drawn outside the op so that the
+    recomputation sees the same ones."""
+    boundary = list(boundary)
+    nodes = theano.gof.graph.io_toposort(boundary, [output])
+    inner = set(boundary)
+    for node in nodes:
+        if not is_random(node) and any(input in inner for input in node.inputs):
+            inner.update(node.outputs)
+    if output not in inner:
+        raise ValueError("%s doesn't depend on %s" % (output, boundary))
+
+    # the op's inputs are the outside variables used by the inner nodes
+    inputs = []
+    for node in nodes:
+        if not any(output_ in inner for output_ in node.outputs):
+            continue
+        for input in node.inputs:
+            if (input not in inputs and
+                not isinstance(input, theano.gof.Constant) and
+                (input in boundary or input not in inner)):
+                inputs.append(input)
+
+    # differentiate only with respect to the boundary and whatever
+    # depends on parameters.  the rest is data (e.g. the image, which the
+    # crop slices) or random numbers, whose gradients would be as large
+    # as they are useless.
+    differentiable = [input in boundary or any(
+                          isinstance(root, theano.compile.SharedVariable)
+                          and not hasattr(root, "default_update")
+                          for root in theano.gof.graph.inputs([input]))
+                      for input in inputs]
+
+    placeholders = [input.type() for input in inputs]
+    inner_output = theano.clone(output, replace=OrderedDict(
+        util.equizip(inputs, placeholders)))
+    strays = [var for var in theano.gof.graph.inputs([inner_output])
+              if var not in placeholders and not isinstance(var, theano.gof.Constant)]
+    assert not strays
+    return Rematerialized(placeholders, [inner_output], differentiable)(*inputs)
+
+class RematerializeTransform(object):
+    """rematerialize the variable from the ancestors that were passed as
+    `boundary`, which are found by their `original_id`."""
+    def __init__(self, boundary):
+        tag_with_ids(boundary)
+        self.boundary_ids = [var.tag.original_id for var in boundary]
+
+    def __str__(self):
+        return "rematerialize"
+
+    def __call__(self, output, **hyperparameters):
+        ancestors = theano.gof.graph.ancestors([output])
+        boundary = [util.the([var for var in ancestors
+                              if getattr(var.tag, "original_id", None) == id_])
+                    for id_ in self.boundary_ids]
+        return rematerialize(output, boundary)
@@ -10,12 +10,20 @@ import util, attention, crop, tasks, dump, graph, bricks
 # map_variables.
 T.constant.enable = False
 
+logger = logging.getLogger(__name__)
 floatX = theano.config.floatX
 
 @util.checkargs
-def construct_model(patch_shape, hidden_dim, hyperparameters, **kwargs):
+def construct_model(patch_shape, hidden_dim, hyperparameters, cutoff,
+                    kernel="gaussian", **kwargs):
+    if kernel == "gaussian":
+        kernel = crop.Gaussian()
+    elif kernel == "tabulated_gaussian":
+        kernel = crop.TabulatedGaussian(radius=cutoff)
+    else:
+        raise ValueError("unknown kernel %s" % kernel)
     cropper = crop.Cropper(
-        name="cropper", kernel=crop.Gaussian(),
+        name="cropper", kernel=kernel,
         patch_shape=patch_shape, hyperparameters=hyperparameters)
     return attention.RecurrentAttentionModel(
         hidden_dim=hidden_dim, cropper=cropper,
@@ -27,7 +35,8 @@ def construct_model(patch_shape, hidden_dim, hyperparameters, **kwargs):
 def construct_monitors(algorithm, task, model, graphs, outputs,
                        updates, monitor_options, n_spatial_dims,
                        plot_url, hyperparameters,
-                       patchmonitor_interval, **kwargs):
+                       patchmonitor_interval, patchmonitor_raw=False,
+                       **kwargs):
     from blocks.extensions.monitoring import TrainingDataMonitoring, DataStreamMonitoring
 
     extensions = []
@@ -139,9 +148,11 @@ def construct_monitors(algorithm, task, model, graphs, outputs,
                     save_to="%s_patches_%s" % (hyperparameters["name"], which),
                     data_stream=task.get_stream(which, shuffle=False, num_examples=10),
                     every_n_batches=patchmonitor_interval,
+                    raw=patchmonitor_raw,
                     extractor=patch_extractor,
                     map_to_input_space=attention.static_map_to_input_space)
-                patchmonitor.save_patches("patchmonitor_test.png")
+                if not patchmonitor_raw:
+                    patchmonitor.save_patches("patchmonitor_test.png")
                 extensions.append(patchmonitor)
 
     if plot_url:
@@ -157,7 +168,9 @@ def construct_monitors(algorithm, task, model, graphs, outputs,
     return extensions
 
 @util.checkargs
-def prepare_mode(mode, outputs, ram, emitter, hyperparameters, **kwargs):
+def prepare_mode(mode, outputs, ram, emitter, hyperparameters,
+                 fold_batch_normalization=False, rematerialize=False,
+                 **kwargs):
     if mode == "training":
         hyperparameters["rng"] = util.get_rng(seed=1)
         emitter.tag_dropout(outputs, **hyperparameters)
@@ -169,12 +182,26 @@ def prepare_mode(mode, outputs, ram, emitter, hyperparameters, **kwargs):
                                          hyperparameters=hyperparameters)
         logger.warning("%i variables in %s graph" % (graph.graph_size(outputs), mode))
 
+        if rematerialize:
+            if hyperparameters["batch_normalize_patch"]:
+                # the population statistics would be updated from the
+                # batch statistics inside the recomputed ops
+                raise ValueError("can't rematerialize batch-normalized patch networks")
+            outputs = graph.apply_transforms(outputs, reason="rematerialization",
+                                             hyperparameters=hyperparameters)
+
         updates = bricks.BatchNormalization.get_updates(outputs)
         print "batch normalization updates:", updates
 
         return outputs, updates
     elif mode == "inference":
         logger.warning("%i variables in %s graph" % (graph.graph_size(outputs), mode))
+        if fold_batch_normalization:
+            # folds into the weights whatever it can; the rest is
+            # handled by population_normalization below
+            outputs = graph.apply_transforms(
+                outputs, reason="batch_normalization_folding",
+                hyperparameters=hyperparameters)
         outputs = graph.apply_transforms(
             outputs, reason="population_normalization",
             hyperparameters=hyperparameters)
@@ -182,26 +209,32 @@ def prepare_mode(mode, outputs, ram, emitter, hyperparameters, **kwargs):
         return outputs, []
 
 @util.checkargs
-def construct_graphs(task, n_patches, hyperparameters, **kwargs):
-    x, x_shape, y = task.get_variables()
-
-    ram = construct_model(task=task, **hyperparameters)
-    ram.initialize()
-
-    scopes = []
-    scopes.append(ram.apply(util.Scope(x=x, x_shape=x_shape), initial=True))
-    n_steps = n_patches - 1
-    for i in xrange(n_steps):
-        scopes.append(ram.apply(util.Scope(
-            x=x, x_shape=x_shape,
-            previous_states=scopes[-1].rnn_outputs)))
-
-    emitter = task.get_emitter(
-        input_dim=ram.get_dim("states"),
-        **hyperparameters)
-    emitter.initialize()
-
-    emitter_outputs = emitter.emit(scopes[-1].rnn_outputs["states"], y)
+def construct_graphs(task, n_patches, hyperparameters, timeline=None, **kwargs):
+    timeline = timeline or util.Timeline()
+
+    with timeline.phase("get variables"):
+        x_stored, x_shape, y = task.get_variables()
+        # the features may be stored at reduced precision
+        x = task.upcast(x_stored)
+
+    with timeline.phase("construct model"):
+        ram = construct_model(task=task, **hyperparameters)
+        ram.initialize()
+
+        scopes = []
+        scopes.append(ram.apply(util.Scope(x=x, x_shape=x_shape), initial=True))
+        n_steps = n_patches - 1
+        for i in xrange(n_steps):
+            scopes.append(ram.apply(util.Scope(
+                x=x, x_shape=x_shape,
+                previous_states=scopes[-1].rnn_outputs)))
+
+        emitter = task.get_emitter(
+            input_dim=ram.get_dim("states"),
+            **hyperparameters)
+        emitter.initialize()
+
+        emitter_outputs = emitter.emit(scopes[-1].rnn_outputs["states"], y)
     emitter_cost = emitter_outputs.cost.copy(name="emitter_cost")
     excursion_cost = (T.stack([scope.excursion for scope in scopes])
                       .mean().copy(name="excursion_cost"))
@@ -213,6 +246,8 @@ def construct_graphs(task, n_patches, hyperparameters, **kwargs):
     outputs_by_name = OrderedDict()
     for key in "x x_shape emitter_cost excursion_cost cost".split():
         outputs_by_name[key] = locals()[key]
+    # feed the data as stored
+    outputs_by_name["x"] = x_stored
     for key in task.monitor_outputs():
         outputs_by_name[key] = emitter_outputs[key]
     for key in "true_location true_scale raw_location raw_scale patch savings".split():
@@ -226,9 +261,10 @@ def construct_graphs(task, n_patches, hyperparameters, **kwargs):
         ("test", "inference")])
     outputs_by_mode, updates_by_mode = OrderedDict(), OrderedDict()
     for mode in "training inference".split():
-        (outputs_by_mode[mode],
-         updates_by_mode[mode]) = prepare_mode(
-             mode, outputs, ram=ram, emitter=emitter, **hyperparameters)
+        with timeline.phase("prepare %s graph" % mode):
+            (outputs_by_mode[mode],
+             updates_by_mode[mode]) = prepare_mode(
+                 mode, outputs, ram=ram, emitter=emitter, **hyperparameters)
     # inference updates may make sense at some point but don't know
     # where to put them now
     assert not updates_by_mode["inference"]
@@ -247,12 +283,48 @@ def construct_graphs(task, n_patches, hyperparameters, **kwargs):
 
     return graphs_by_set, outputs_by_set, updates_by_set
 
+@util.checkargs
+def construct_algorithm(graphs, outputs, updates, learning_rate,
+                        gradient_limiter, compressor_median_estimator="exact",
+                        n_workers=1, ragged=False, **kwargs):
+    from blocks.algorithms import GradientDescent, CompositeRule, StepClipping, Adam, RMSProp
+    from extensions import Compressor
+    if gradient_limiter == "clip":
+        limiter = StepClipping(1.)
+    elif gradient_limiter == "compress":
+        limiter = Compressor(median_estimator=compressor_median_estimator)
+    else:
+        raise ValueError()
+
+    step_rule = CompositeRule([limiter, Adam(learning_rate=learning_rate)])
+    if n_workers > 1:
+        if ragged:
+            # the shards are sliced along the first axis, which for
+            # ragged features runs over the frames of all examples
+            raise ValueError("ragged batches can't be split across workers")
+        from parallel import DataParallelGradientDescent
+        algorithm = DataParallelGradientDescent(
+            cost=outputs["train"]["cost"],
+            parameters=graphs["train"].parameters,
+            step_rule=step_rule, n_workers=n_workers)
+    else:
+        algorithm = GradientDescent(
+            cost=outputs["train"]["cost"],
+            parameters=graphs["train"].parameters,
+            step_rule=step_rule)
+    algorithm.add_updates(updates["train"])
+    return algorithm
+
 @util.checkargs
 def construct_main_loop(name, task_name, patch_shape, batch_size,
                         n_spatial_dims, n_patches, max_epochs,
-                        patience_epochs, learning_rate, gradient_limiter,
-                        hyperparameters, **kwargs):
-    task = tasks.get_task(**hyperparameters)
+                        patience_epochs, hyperparameters,
+                        profile_every_n_epochs=None, profile_n_batches=10,
+                        timeline=None, **kwargs):
+    timeline = timeline or util.Timeline()
+
+    with timeline.phase("construct task"):
+        task = tasks.get_task(**hyperparameters)
     hyperparameters["n_channels"] = task.n_channels
 
     extensions = []
@@ -266,56 +338,69 @@ def construct_main_loop(name, task_name, patch_shape, batch_size,
             after_batch=True))
 
     print "constructing graphs..."
-    graphs, outputs, updates = construct_graphs(task=task, **hyperparameters)
+    with timeline.phase("construct graphs"):
+        graphs, outputs, updates = construct_graphs(
+            task=task, timeline=timeline, **hyperparameters)
 
     print "setting up main loop..."
 
     from blocks.model import Model
     model = Model(outputs["train"]["cost"])
 
-    from blocks.algorithms import GradientDescent, CompositeRule, StepClipping, Adam, RMSProp
-    from extensions import Compressor
-    if gradient_limiter == "clip":
-        limiter = StepClipping(1.)
-    elif gradient_limiter == "compress":
-        limiter = Compressor()
-    else:
-        raise ValueError()
-
-    algorithm = GradientDescent(
-        cost=outputs["train"]["cost"],
-        parameters=graphs["train"].parameters,
-        step_rule=CompositeRule([limiter, Adam(learning_rate=learning_rate)]))
-    algorithm.add_updates(updates["train"])
+    with timeline.phase("construct algorithm"):
+        algorithm = construct_algorithm(graphs=graphs, outputs=outputs,
+                                        updates=updates, **hyperparameters)
 
-    extensions.extend(construct_monitors(
-        algorithm=algorithm, task=task, model=model, graphs=graphs,
-        outputs=outputs, updates=updates, **hyperparameters))
+    with timeline.phase("construct monitors"):
+        extensions.extend(construct_monitors(
+            algorithm=algorithm, task=task, model=model, graphs=graphs,
+            outputs=outputs, updates=updates, **hyperparameters))
 
     from blocks.extensions import FinishAfter, Printing, ProgressBar, Timing
     from blocks.extensions.stopping import FinishIfNoImprovementAfter
     from blocks.extensions.training import TrackTheBest
     from blocks.extensions.saveload import Checkpoint
-    from dump import DumpBest, LightCheckpoint, PrintingTo, DumpGraph, DumpLog
+    from dump import DumpBest, LightCheckpoint, PrintingTo, DumpGraph, AppendLog
+    from extensions import PipelineMonitoring
     extensions.extend([
+        PipelineMonitoring(after_epoch=True),
         TrackTheBest("valid_error_rate", "best_valid_error_rate"),
         FinishIfNoImprovementAfter("best_valid_error_rate", epochs=patience_epochs),
         FinishAfter(after_n_epochs=max_epochs),
-        DumpBest("best_valid_error_rate", name+"_best.zip"),
+        DumpBest("best_valid_error_rate", name+"_best.zip",
+                 background=True),
+        # before Checkpoint, so that the rows reach the checkpoint
+        AppendLog(name+"_log_rows.pkl", after_epoch=True),
         Checkpoint(hyperparameters["checkpoint_save_path"],
                    on_interrupt=False, every_n_epochs=10,
                    use_cpickle=True),
-        DumpLog("log.pkl", after_epoch=True),
         ProgressBar(),
         Timing(),
         Printing(), PrintingTo(name+"_log"),
         DumpGraph(name+"_grad_graph")])
 
+    if profile_every_n_epochs:
+        from blocks.extensions.monitoring import DataStreamMonitoring
+        from extensions import ProfileWindow
+        extensions.append(ProfileWindow(
+            name + "_profile", every_n_epochs=profile_every_n_epochs,
+            n_batches=profile_n_batches,
+            monitors=[extension for extension in extensions
+                      if isinstance(extension, DataStreamMonitoring)]))
+
+    if hyperparameters.get("n_workers", 1) > 1:
+        from parallel import StopWorkers
+        extensions.append(StopWorkers())
+
+    from extensions import StartupTimeline
+    extensions.append(StartupTimeline(timeline, name + "_startup.txt"))
+
     from blocks.main_loop import MainLoop
-    main_loop = MainLoop(data_stream=task.get_stream("train"),
-                         algorithm=algorithm,
-                         extensions=extensions,
-                         model=model)
+    with timeline.phase("construct main loop"):
+        main_loop = MainLoop(data_stream=task.get_stream("train"),
+                             algorithm=algorithm,
+                             extensions=extensions,
+                             model=model)
 
     from tabulate import tabulate
     print "parameter sizes:"
@@ -324,11 +409,23 @@ def construct_main_loop(name, task_name, patch_shape, batch_size,
 
     return main_loop
 
+def load_hyperparameters(path=None):
+    if path is None:
+        path = os.path.join(os.path.dirname(__file__), "defaults.yaml")
+
+    with open(path, "rb") as f:
+        hyperparameters = yaml.load(f)
+
+    hyperparameters["n_spatial_dims"] = len(hyperparameters["patch_shape"])
+    hyperparameters["hyperparameters"] = hyperparameters
+    hyperparameters["name"] += "_" + hyperparameters["task_name"]
+    hyperparameters["checkpoint_save_path"] = hyperparameters["name"] + "_checkpoint.zip"
+    return hyperparameters
+
 if __name__ == "__main__":
     np.random.seed(1)
 
     logging.basicConfig()
-    logger = logging.getLogger(__name__)
 
     import argparse
 
@@ -339,17 +436,7 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    hyperparameters_path = getattr(
-        args, "hyperparameters",
-        os.path.join(os.path.dirname(__file__), "defaults.yaml"))
-
-    with open(hyperparameters_path, "rb") as f:
-        hyperparameters = yaml.load(f)
-
-    hyperparameters["n_spatial_dims"] = len(hyperparameters["patch_shape"])
-    hyperparameters["hyperparameters"] = hyperparameters
-    hyperparameters["name"] += "_" + hyperparameters["task_name"]
-    hyperparameters["checkpoint_save_path"] = hyperparameters["name"] + "_checkpoint.zip"
+    hyperparameters = load_hyperparameters(args.hyperparameters)
 
     checkpoint_path = None
     if args.autoresume and os.path.exists(hyperparameters["checkpoint_save_path"]):
@@ -359,6 +446,17 @@ if __name__ == "__main__":
     if checkpoint_path:
         from blocks.serialization import load
         main_loop = load(checkpoint_path)
+        # rebuild the log from the rows appended by AppendLog, up to
+        # where the checkpoint was taken
+        log_path = hyperparameters["name"] + "_log_rows.pkl"
+        iterations_done = main_loop.log.status["iterations_done"]
+        if os.path.exists(log_path):
+            log = dump.load_log(log_path, iterations_done)
+            if log.status.get("iterations_done") == iterations_done:
+                main_loop.log = log
+            else:
+                logger.warning("%s doesn't reach the checkpoint; using the checkpoint's log"
+                               % log_path)
     else:
         main_loop = construct_main_loop(**hyperparameters)
 
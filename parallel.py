@@ -0,0 +1,269 @@
+"""data-parallel training across local processes.
+
+each batch is split into `n_workers` shards along the batch axis.  the
+main process computes the gradient on the first shard and forked worker
+processes compute it on the others, all with the same compiled function.
+the results are passed through shared memory and averaged, weighted by
+shard size, before the step rule is applied once in the main process.
+
+the updates added to the algorithm (e.g. the batch normalization
+population statistics) are computed per shard and averaged in the same
+way.  for the exponential moving averages of the population statistics
+this is the same as updating with the average of the shard statistics.
+note that batch normalization itself normalizes by shard statistics.
+
+updates that read the step, such as the step and gradient norms that
+`TrainingDataMonitoring` accumulates, can't be computed per shard.  they
+are applied along with the step after the gradients have been reduced.
+
+each process runs its own BLAS/OpenMP threads; set OMP_NUM_THREADS and
+friends to about the number of cores divided by `n_workers`.
+"""
+import logging, traceback, multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from collections import OrderedDict
+import numpy as np
+import theano
+from theano.compile import SharedVariable
+from blocks.algorithms import GradientDescent
+from blocks.extensions import SimpleExtension
+from blocks.utils import shared_like
+import util
+
+logger = logging.getLogger(__name__)
+
+def shared_array(shape, dtype):
+    # numpy view on a block of memory that survives forking
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = RawArray("b", max(1, size * dtype.itemsize))
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+def reseed_mrg_state(rstate, n_jumps):
+    # jump each stream ahead by n_jumps * 2**134 so that the processes
+    # draw from disjoint substreams
+    from theano.sandbox.rng_mrg import ff_2p134
+    rstate = np.array(rstate)
+    if rstate.dtype != np.int32 or rstate.shape[-1] != 6:
+        logger.warning("not reseeding random state of unknown kind")
+        return rstate
+    for i in xrange(n_jumps):
+        rstate = np.array([ff_2p134(row) for row in rstate], dtype=rstate.dtype)
+    return rstate
+
+class DataParallelGradientDescent(GradientDescent):
+    def __init__(self, cost, parameters, n_workers, consider_constant=None,
+                 known_grads=None, **kwargs):
+        if n_workers < 1:
+            raise ValueError("need at least one worker")
+        self.n_workers = n_workers
+        # the gradient on a single shard
+        self.shard_gradients = OrderedDict(util.equizip(
+            parameters, theano.grad(cost, parameters,
+                                    consider_constant=consider_constant,
+                                    known_grads=known_grads)))
+        # the step rule sees the averaged gradients, which are filled in
+        # after the shards have been processed
+        self.reduced_gradients = OrderedDict(
+            (parameter, shared_like(parameter, name="reduced_gradient:%s" % parameter.name))
+            for parameter in parameters)
+        super(DataParallelGradientDescent, self).__init__(
+            cost=cost, parameters=parameters,
+            gradients=self.reduced_gradients, **kwargs)
+        # the updates so far are the step; anything added later is
+        # computed per shard
+        self.step_updates = list(self.updates)
+        # updates that read the step; determined in `initialize`
+        self.reduced_updates = []
+        self.workers = None
+
+    @property
+    def shard_updates(self):
+        step_variables = set(variable for variable, _
+                             in self.step_updates + self.reduced_updates)
+        return [(variable, update) for variable, update in self.updates
+                if variable not in step_variables]
+
+    @property
+    def shard_outputs(self):
+        # the gradients and the new values of the per-shard updates
+        return (list(self.shard_gradients.values()) +
+                [update for _, update in self.shard_updates])
+
+    def compile_shard_function(self, **kwargs):
+        # computes the shard outputs but doesn't apply anything
+        kwargs = dict(self.theano_func_kwargs, **kwargs)
+        return theano.function(self.shard_inputs, self.shard_outputs,
+                               on_unused_input="ignore", **kwargs)
+
+    def initialize(self):
+        logger.info("initializing data-parallel training algorithm")
+        from blocks.graph import ComputationGraph
+        data = set(ComputationGraph(
+            [self.cost] + [update for _, update in self.updates]).inputs)
+
+        # the parameters are synced before each shard, so updates that
+        # read them can be computed per shard.  the reduced gradients and
+        # the step rule's state are only up to date after the reduction.
+        step_state = set(self.reduced_gradients.values())
+        step_state.update(variable for variable, _ in self.step_updates
+                          if variable not in self.shard_gradients)
+        self.reduced_updates = []
+        for variable, update in self.shard_updates:
+            inputs = theano.gof.graph.inputs([update])
+            if not step_state.intersection(inputs):
+                continue
+            if data.intersection(inputs):
+                raise ValueError(
+                    "update of %s depends on both the data and the step"
+                    % variable)
+            self.reduced_updates.append((variable, update))
+
+        self.shard_inputs = ComputationGraph(
+            [self.cost] + [update for _, update in self.shard_updates]).inputs
+        self.inputs = self.shard_inputs
+        # `_function` processes the main process's shard
+        self._function = self.compile_shard_function()
+        self._step_function = theano.function(
+            [], [], updates=self.step_updates + self.reduced_updates,
+            **self.theano_func_kwargs)
+
+    def __getstate__(self):
+        # processes and shared memory don't pickle; they are restarted
+        # on the next batch
+        state = dict(self.__dict__)
+        for key in "workers connections synced_buffers output_buffers".split():
+            state.pop(key, None)
+        state["workers"] = None
+        return state
+
+    def start_workers(self):
+        variables = theano.gof.graph.inputs(self.shard_outputs)
+        # the values of these are pushed to the workers before each
+        # batch.  random states are left alone; each process keeps its
+        # own after reseeding.
+        self.synced_buffers = [
+            (variable, shared_array(variable.get_value(borrow=True).shape,
+                                    variable.dtype))
+            for variable in variables
+            if isinstance(variable, SharedVariable)
+            and not hasattr(variable, "default_update")]
+        self.random_states = [
+            variable for variable in variables
+            if isinstance(variable, SharedVariable)
+            and hasattr(variable, "default_update")]
+        self.output_shapes = (
+            [parameter.get_value(borrow=True).shape for parameter in self.shard_gradients.keys()] +
+            [variable.get_value(borrow=True).shape for variable, _ in self.shard_updates])
+        self.output_dtypes = (
+            [parameter.dtype for parameter in self.shard_gradients.keys()] +
+            [variable.dtype for variable, _ in self.shard_updates])
+        self.output_buffers = [
+            [shared_array(shape, dtype) for shape, dtype
+             in zip(self.output_shapes, self.output_dtypes)]
+            for index in xrange(self.n_workers - 1)]
+
+        self.workers, self.connections = [], []
+        for index in xrange(self.n_workers - 1):
+            connection, worker_connection = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=self.work, args=(index, worker_connection),
+                name="gradient worker %i" % index)
+            worker.daemon = True
+            worker.start()
+            worker_connection.close()
+            self.workers.append(worker)
+            self.connections.append(connection)
+        logger.warning("started %i gradient workers" % len(self.workers))
+
+    def work(self, index, connection):
+        for variable in self.random_states:
+            variable.set_value(reseed_mrg_state(variable.get_value(), index + 1))
+        np.random.seed(index + 1)
+
+        while True:
+            try:
+                shard = connection.recv()
+            except EOFError:
+                # main process is gone
+                break
+            if shard is None:
+                break
+            try:
+                for variable, buffer in self.synced_buffers:
+                    variable.set_value(buffer)
+                outputs = self._function(*shard)
+                for buffer, output in zip(self.output_buffers[index], outputs):
+                    buffer[...] = output
+                connection.send(None)
+            except:
+                connection.send(traceback.format_exc())
+
+    def stop_workers(self):
+        if self.workers is None:
+            return
+        for connection in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = None
+
+    def process_batch(self, batch):
+        self._validate_source_names(batch)
+        if self.workers is None:
+            self.start_workers()
+
+        for variable, buffer in self.synced_buffers:
+            buffer[...] = variable.get_value(borrow=True)
+
+        ordered_batch = [batch[variable.name] for variable in self.shard_inputs]
+        batch_size = len(ordered_batch[0])
+        boundaries = np.linspace(0, batch_size, self.n_workers + 1).round().astype(int)
+        shards = [[data[a:b] for data in ordered_batch]
+                  for a, b in zip(boundaries[:-1], boundaries[1:])]
+        weights = np.diff(boundaries) / float(batch_size)
+
+        busy = []
+        for index, (connection, shard) in enumerate(zip(self.connections, shards[1:])):
+            if len(shard[0]):
+                connection.send(shard)
+                busy.append(index)
+
+        # with fewer examples than workers, the first shards are empty;
+        # the cost of an empty shard would be nan
+        totals = None
+        try:
+            if len(shards[0][0]):
+                totals = [weights[0] * output for output in self._function(*shards[0])]
+        finally:
+            # collect the workers' results even if ours failed, so
+            # that they are in sync for the next batch
+            errors = []
+            for index in busy:
+                error = self.connections[index].recv()
+                if error is not None:
+                    errors.append("gradient worker %i failed:\n%s" % (index, error))
+        for index in busy:
+            outputs = [weights[index + 1] * buffer for buffer in self.output_buffers[index]]
+            totals = (outputs if totals is None else
+                      [total + output for total, output in zip(totals, outputs)])
+        if errors:
+            raise RuntimeError("\n".join(errors))
+
+        n_gradients = len(self.reduced_gradients)
+        for gradient, total in zip(self.reduced_gradients.values(), totals[:n_gradients]):
+            gradient.set_value(total.astype(gradient.dtype))
+        for (variable, _), total in zip(self.shard_updates, totals[n_gradients:]):
+            variable.set_value(np.asarray(total, dtype=variable.dtype))
+
+        self._step_function()
+
+class StopWorkers(SimpleExtension):
+    """stop the gradient workers when training is done.  they are
+    daemons, so they die with the main process anyway."""
+    def __init__(self, **kwargs):
+        kwargs.setdefault("after_training", True)
+        super(StopWorkers, self).__init__(**kwargs)
+
+    def do(self, which_callback, *args):
+        self.main_loop.algorithm.stop_workers()
@@ -13,28 +13,65 @@ import matplotlib.patches
 
 from blocks.extensions import SimpleExtension
 
-class PatchMonitoring(SimpleExtension):
-    def __init__(self, data_stream, extractor, map_to_input_space, save_to=".", **kwargs):
+# keys of the arrays in a raw patch dump
+RAW_KEYS = tuple("images image_shapes locationss scaless patchess".split())
+
+def upcast_images(images):
+    # the images may be stored at reduced precision
+    if images.dtype == np.uint8:
+        return images.astype(np.float32) / 255.
+    return images.astype(np.float32)
+
+class BasePatchMonitoring(SimpleExtension):
+    # if `raw` is set, the extracted arrays are dumped to an npz file
+    # per iteration instead of being rendered, which keeps the cost
+    # during training down to a binary write. the dumps can be
+    # rendered afterwards by running this module as a script.
+    # subclasses define `render_patches` and `filename_suffix`.
+    def __init__(self, data_stream, extractor, map_to_input_space, save_to=".", raw=False, **kwargs):
         if not os.path.isdir(save_to):
             os.makedirs(save_to)
         self.data_stream = data_stream
         self.save_to = save_to
         self.extractor = extractor
         self.map_to_input_space = map_to_input_space
-        self.colors = dict()
-        super(PatchMonitoring, self).__init__(**kwargs)
+        self.raw = raw
+        super(BasePatchMonitoring, self).__init__(**kwargs)
 
     def do(self, which_callback, *args):
         current_dir = os.getcwd()
         os.chdir(self.save_to)
-        self.save_patches("patches_iteration_%i.png" % self.main_loop.status['iterations_done'])
+        stem = "patches_iteration_%i" % self.main_loop.status['iterations_done']
+        if self.raw:
+            self.dump_patches(stem + ".npz")
+        else:
+            self.save_patches(stem + self.filename_suffix)
         os.chdir(current_dir)
 
-    def save_patches(self, filename):
+    def extract_patches(self):
         batch = self.data_stream.get_epoch_iterator(as_dict=True).next()
         images, image_shapes = batch['features'], batch['shapes']
         locationss, scaless, patchess = self.extractor(images, image_shapes)
+        if images.ndim == image_shapes.shape[1] + 1:
+            # ragged batch; see transformers.RaggedShape
+            from transformers import pad_ragged
+            images = pad_ragged(images, image_shapes)
+        # the images are left in their stored dtype to keep raw dumps
+        # small; they are upcast for rendering
+        return dict(zip(RAW_KEYS, (images, image_shapes, locationss, scaless, patchess)))
+
+    def dump_patches(self, filename):
+        np.savez(filename, **self.extract_patches())
+
+    def save_patches(self, filename):
+        patches = self.extract_patches()
+        patches["images"] = upcast_images(patches["images"])
+        self.render_patches(filename, **patches)
+
+class PatchMonitoring(BasePatchMonitoring):
+    filename_suffix = ".png"
 
+    def render_patches(self, filename, images, image_shapes, locationss, scaless, patchess):
         batch_size = images.shape[0]
         npatches = patchess.shape[1]
         patch_shape = patchess.shape[-2:]
@@ -94,26 +131,12 @@ class PatchMonitoring(SimpleExtension):
         kwargs.setdefault("shape", image.shape)
         plt.imshow(image, *args, **kwargs)
 
-class VideoPatchMonitoring(SimpleExtension):
-    def __init__(self, data_stream, extractor, map_to_input_space, save_to=".", **kwargs):
-        if not os.path.isdir(save_to):
-            os.makedirs(save_to)
-        self.data_stream = data_stream
-        self.save_to = save_to
-        self.extractor = extractor
-        self.map_to_input_space = map_to_input_space
-        super(VideoPatchMonitoring, self).__init__(**kwargs)
-
-    def do(self, which_callback, *args):
-        current_dir = os.getcwd()
-        os.chdir(self.save_to)
-        self.save_patches("patches_iteration_%i" % self.main_loop.status['iterations_done'])
-        os.chdir(current_dir)
+class VideoPatchMonitoring(BasePatchMonitoring):
+    # render_patches writes one file per example, using the filename as a stem
+    filename_suffix = ""
 
-    def save_patches(self, filename_stem):
-        batch = self.data_stream.get_epoch_iterator(as_dict=True).next()
-        videos, video_shapes = batch['features'], batch['shapes']
-        locationss, scaless, patchess = self.extractor(videos, video_shapes)
+    def render_patches(self, filename_stem, images, image_shapes, locationss, scaless, patchess):
+        videos, video_shapes = images, image_shapes
 
         patch_shape = patchess.shape[-3:]
 
@@ -189,3 +212,37 @@ class VideoPatchMonitoring(SimpleExtension):
         kwargs.setdefault("vmax", 1.0)
         kwargs.setdefault("shape", image.shape)
         plt.imshow(image, *args, **kwargs)
+
+def render_dump(path, save_to=None):
+    # render a raw patch dump written by BasePatchMonitoring.dump_patches
+    import attention
+    data = np.load(path)
+    patches = dict((key, data[key]) for key in RAW_KEYS)
+    patches["images"] = upcast_images(patches["images"])
+    # patchess is (batch, patch, channel) + spatial dims
+    klass = {2: PatchMonitoring,
+             3: VideoPatchMonitoring}[patches["patchess"].ndim - 3]
+    if save_to is None:
+        save_to = os.path.dirname(path) or "."
+    monitor = klass(data_stream=None, extractor=None,
+                    map_to_input_space=attention.static_map_to_input_space,
+                    save_to=save_to)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    monitor.render_patches(os.path.join(save_to, stem + klass.filename_suffix), **patches)
+
+if __name__ == "__main__":
+    import argparse, glob
+
+    parser = argparse.ArgumentParser(description="Render raw patch dumps")
+    parser.add_argument("paths", nargs="+", help="npz dumps or directories containing them")
+    parser.add_argument("--save-to", help="Directory in which to write the figures (default: next to the dumps)")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if os.path.isdir(path):
+            dump_paths = sorted(glob.glob(os.path.join(path, "patches_iteration_*.npz")))
+        else:
+            dump_paths = [path]
+        for dump_path in dump_paths:
+            print "rendering", dump_path
+            render_dump(dump_path, save_to=args.save_to)
@@ -0,0 +1,201 @@
+"""run a grid of hyperparameter trials, compiling once per graph structure.
+
+    python sweep.py --hyperparameters foo.yaml --sweep sweep.yaml --processes 4
+
+sweep.yaml maps hyperparameter names to lists of values; the trials are
+the cartesian product.  the hyperparameters in SHARED_KEYS enter the
+graph as shared variables, so trials that differ only in those share a
+main loop.  regularizers that are switched off are left out of the graph
+as usual, so trials are also grouped by which of them are switched on.
+
+the main loop of each group is constructed and compiled once in this
+process.  each trial runs in a child forked off the pristine main loop,
+which reuses the compiled functions and the loaded data and leaves the
+parent's shared variables untouched.  the trials write their files into
+their own directories, and the results are collected into one table.
+"""
+import os, time, itertools, logging, traceback, multiprocessing
+from collections import OrderedDict
+import numpy as np
+import yaml
+
+logger = logging.getLogger(__name__)
+
+SHARED_KEYS = """learning_rate location_std scale_std classifier_dropout
+attention_dropout recurrent_dropout recurrent_weight_noise""".split()
+# these are skipped in the graph when they are zero
+REGULARIZER_KEYS = """classifier_dropout attention_dropout recurrent_dropout
+recurrent_weight_noise""".split()
+
+def get_trials(sweep):
+    keys = list(sweep.keys())
+    return [OrderedDict(zip(keys, values))
+            for values in itertools.product(*[sweep[key] for key in keys])]
+
+def get_structure(trial):
+    # trials with equal structure can share a compiled main loop
+    structure = []
+    for key, value in sorted(trial.items()):
+        if key not in SHARED_KEYS:
+            # values may be unhashable lists
+            structure.append((key, repr(value)))
+        elif key in REGULARIZER_KEYS:
+            structure.append((key, value > 0))
+    return tuple(structure)
+
+def already_initialized():
+    # stands in for the algorithm's `initialize` in the trials, which
+    # would compile the training function again.  module-level so that
+    # checkpoints still pickle.
+    pass
+
+def construct_group(hyperparameters, trials):
+    import main
+    from blocks.utils import shared_floatx
+    if hyperparameters.get("n_workers", 1) > 1:
+        raise ValueError("trials can't fork gradient workers; use --processes instead")
+
+    hyperparameters = dict(hyperparameters)
+    hyperparameters.update(trials[0])
+    hyperparameters["hyperparameters"] = hyperparameters
+    for key in SHARED_KEYS:
+        if key in ("learning_rate", "location_std", "scale_std"):
+            # these are shared already
+            continue
+        if key in trials[0] and trials[0][key] > 0:
+            hyperparameters[key] = shared_floatx(trials[0][key], name=key)
+
+    main_loop = main.construct_main_loop(**hyperparameters)
+    algorithm = main_loop.algorithm
+    # the training data monitors add their accumulation updates to the
+    # algorithm before training, which must happen before it is
+    # compiled.  they add them again in the trials, to no effect as the
+    # algorithm isn't compiled again.
+    from blocks.extensions.monitoring import TrainingDataMonitoring
+    for extension in main_loop.extensions:
+        if isinstance(extension, TrainingDataMonitoring):
+            extension.dispatch("before_training")
+    algorithm.initialize()
+    algorithm.initialize = already_initialized
+    return main_loop, hyperparameters
+
+def set_trial_values(main_loop, hyperparameters, trial):
+    from blocks.algorithms import Adam
+    for key, value in trial.items():
+        if key not in SHARED_KEYS:
+            continue
+        if key == "learning_rate":
+            variable, = [step_rule.learning_rate
+                         for step_rule in main_loop.algorithm.step_rule.components
+                         if isinstance(step_rule, Adam)]
+        else:
+            variable = hyperparameters[key]
+        if not hasattr(variable, "set_value"):
+            # switched off in this group
+            assert not value > 0
+            continue
+        variable.set_value(np.asarray(value, dtype=variable.dtype))
+
+def summarize_log(log):
+    rows = [log[iteration] for iteration in sorted(log.keys())]
+    def last(key):
+        values = [row[key] for row in rows if key in row]
+        return float(values[-1]) if values else None
+    valid_error_rates = [float(row["valid_error_rate"]) for row in rows
+                         if "valid_error_rate" in row]
+    return OrderedDict([
+        ("best_valid_error_rate", min(valid_error_rates) if valid_error_rates else None),
+        ("valid_error_rate", last("valid_error_rate")),
+        ("train_cost", last("train_cost")),
+        ("epochs", log.status["epochs_done"]),
+        ("iterations", log.status["iterations_done"])])
+
+# the group being run; the pool's children inherit it by forking
+_group = None
+
+def run_trial(index):
+    main_loop, hyperparameters, trials, directory = _group
+    trial = trials[index]
+    path = os.path.join(directory, "trial%03i" % index)
+    try:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        os.chdir(path)
+        with open("hyperparameters.yaml", "w") as f:
+            yaml.dump(dict(trial), f)
+        set_trial_values(main_loop, hyperparameters, trial)
+        start = time.time()
+        main_loop.run()
+        result = summarize_log(main_loop.log)
+        result["seconds"] = time.time() - start
+        result["error"] = None
+    except:
+        result = OrderedDict(error=traceback.format_exc())
+    return index, result
+
+def sweep(hyperparameters, trials, directory, n_processes):
+    global _group
+
+    groups = OrderedDict()
+    for index, trial in enumerate(trials):
+        groups.setdefault(get_structure(trial), []).append(index)
+    print "%i trials in %i groups" % (len(trials), len(groups))
+
+    results = [None] * len(trials)
+    for indices in groups.values():
+        print "compiling for trials %s..." % ", ".join(map(str, indices))
+        main_loop, group_hyperparameters = construct_group(
+            hyperparameters, [trials[index] for index in indices])
+        _group = (main_loop, group_hyperparameters, trials, directory)
+        # fork a fresh child from the pristine main loop for each trial
+        pool = multiprocessing.Pool(n_processes, maxtasksperchild=1)
+        try:
+            pending = [pool.apply_async(run_trial, (index,)) for index in indices]
+            for result in pending:
+                index, result = result.get()
+                if result["error"]:
+                    logger.error("trial %i failed:\n%s" % (index, result["error"]))
+                results[index] = result
+        finally:
+            pool.close()
+            pool.join()
+        _group = None
+    return results
+
+def report(trials, results):
+    from tabulate import tabulate
+    keys = list(trials[0].keys())
+    result_keys = "best_valid_error_rate valid_error_rate train_cost epochs seconds".split()
+    rows = [[index] + [trial[key] for key in keys] +
+            ([result.get(key) for key in result_keys] if not result["error"]
+             else ["failed"] + [None] * (len(result_keys) - 1))
+            for index, (trial, result) in enumerate(zip(trials, results))]
+    return tabulate(rows, headers=["trial"] + keys + result_keys)
+
+if __name__ == "__main__":
+    logging.basicConfig()
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hyperparameters", help="YAML file from which to load hyperparameters")
+    parser.add_argument("--sweep", required=True, help="YAML file mapping hyperparameters to lists of values")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+
+    args = parser.parse_args()
+
+    import main
+    hyperparameters = main.load_hyperparameters(args.hyperparameters)
+    with open(args.sweep) as f:
+        trials = get_trials(yaml.load(f))
+
+    directory = os.path.abspath(hyperparameters["name"] + "_sweep")
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    results = sweep(hyperparameters, trials, directory, args.processes)
+
+    table = report(trials, results)
+    print table
+    with open(os.path.join(directory, "results.txt"), "w") as f:
+        f.write(table)
+        f.write("\n")
@@ -1,21 +1,20 @@
-from base import Classification
+import importlib
 
-import mnist
-import old_cmv
-import cmv
-import kth
-import ucf101
-import featurelevel_ucf101
-import svhn
-import goodfellow_svhn
+from base import Classification, Source
+
+# the task modules pull in h5py, PIL and the fuel datasets, so they are
+# imported only when the task is asked for
+TASKS = dict(mnist=("mnist", "Task"),
+             old_cmv=("old_cmv", "Task"),
+             cmv=("cmv", "Task"),
+             kth=("kth", "Task"),
+             ucf101=("ucf101", "Task"),
+             featurelevel_ucf101=("featurelevel_ucf101", "Task"),
+             svhn_digit=("svhn", "DigitTask"),
+             svhn_number=("goodfellow_svhn", "NumberTask"))
 
 def get_task(task_name, hyperparameters, **kwargs):
-    klass = dict(mnist=mnist.Task,
-                 old_cmv=old_cmv.Task,
-                 cmv=cmv.Task,
-                 kth=kth.Task,
-                 ucf101=ucf101.Task,
-                 featurelevel_ucf101=featurelevel_ucf101.Task,
-                 svhn_digit=svhn.DigitTask,
-                 svhn_number=goodfellow_svhn.NumberTask)[task_name]
+    module_name, class_name = TASKS[task_name]
+    module = importlib.import_module("%s.%s" % (__name__, module_name))
+    klass = getattr(module, class_name)
     return klass(**hyperparameters)
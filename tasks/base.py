@@ -1,10 +1,13 @@
 import os, logging, functools
+from collections import OrderedDict, namedtuple
 import numpy as np
+import theano
 import theano.tensor as T
 from blocks.filter import VariableFilter
 from fuel.streams import DataStream
 from fuel.schemes import ShuffledScheme, SequentialScheme
 from fuel import transformers
+from transformers import Instrumented
 import emitters, util
 
 logger = logging.getLogger(__name__)
@@ -12,6 +15,10 @@ logger = logging.getLogger(__name__)
 # have the same sources for all tasks
 CANONICAL_SOURCES = tuple("features shapes targets".split())
 
+# what a source looks like after canonicalization.  `example_shape` is
+# the shape of a single example, or None if it isn't known statically.
+Source = namedtuple("Source", "dtype ndim example_shape")
+
 class Canonicalize(transformers.Transformer):
     produces_examples = False
 
@@ -35,17 +42,40 @@ def _center(self, data):
     masks = np.zeros_like(x)
     for i, shape in enumerate(x_shape):
         masks[np.index_exp[i, :] + tuple(map(slice, shape))] = 1
-    x_centered = x - masks * mean
+    # keep the storage dtype
+    x_centered = (x - masks * mean).astype(x.dtype)
     return x_centered, x_shape, y
 
 class Classification(object):
     canonicalize = _canonicalize
     center = _center
+    # dtypes in which the features may be kept on the host; they are
+    # upcast to floatX in the graph by `upcast`
+    storage_dtypes = ("float32", "float16")
+    # number of spatial axes of the features, spatial shape of a typical
+    # example if known, and shape of the targets of a single example;
+    # see `get_source_schema`
+    n_spatial_dims = 2
+    example_shape = None
+    target_shape = ()
+    # whether the task can batch examples of different lengths by
+    # concatenating them; see transformers.RaggedShape
+    supports_ragged = False
+    # the set from which to take example batches if they can't be made up
+    example_batch_set = "valid"
 
     @util.checkargs
-    def __init__(self, batch_size, shrink_dataset_by=1, **kwargs):
+    def __init__(self, batch_size, shrink_dataset_by=1, storage_dtype="float32",
+                 ragged=False, **kwargs):
+        if storage_dtype not in self.storage_dtypes:
+            raise ValueError("%s task does not support storage dtype %s"
+                             % (self.name, storage_dtype))
+        if ragged and not self.supports_ragged:
+            raise ValueError("%s task does not support ragged batches" % self.name)
+        self.ragged = ragged
         self.shrink_dataset_by = shrink_dataset_by
         self.batch_size = batch_size
+        self.storage_dtype = storage_dtype
         self.datasets = self.load_datasets()
 
     def load_datasets(self):
@@ -66,25 +96,92 @@ class Classification(object):
         if num_examples is None:
             num_examples = self.get_stream_num_examples(which_set, monitor=monitor)
         scheme = self.get_scheme(which_set, shuffle=shuffle, monitor=monitor, num_examples=num_examples)
+        # time each stage; see PipelineMonitoring
+        stats = OrderedDict()
         stream = DataStream.default_stream(dataset=self.datasets[which_set], iteration_scheme=scheme)
+        stream = Instrumented(stream, "dataset", stats)
         stream = self.apply_default_transformers(stream, monitor=monitor)
+        stream = Instrumented(stream, "transformers", stats)
         stream = Canonicalize(stream, mapping=util.rebind(self.canonicalize))
+        stream = Instrumented(stream, "canonicalize", stats)
         if center:
             stream = transformers.Mapping(stream, mapping=util.rebind(self.center))
+            stream = Instrumented(stream, "center", stats)
         return stream
 
+    def get_source_schema(self):
+        # must agree with what `get_stream` produces
+        example_shape = self.example_shape
+        if self.ragged:
+            # (total_length, channels) + other spatial axes; the batch
+            # isn't made up
+            features = Source(self.storage_dtype, 1 + self.n_spatial_dims, None)
+        else:
+            features = Source(
+                self.storage_dtype, 2 + self.n_spatial_dims,
+                None if example_shape is None else (self.n_channels,) + tuple(example_shape))
+        return OrderedDict([
+            ("features", features),
+            ("shapes", Source("float32", 2, (self.n_spatial_dims,))),
+            ("targets", Source(
+                "uint8", 1 + len(self.target_shape), self.target_shape))])
+
     def get_variables(self):
+        schema = self.get_source_schema()
+        test_batch = None
+        if theano.config.compute_test_value != "off":
+            test_batch = self.get_example_batch(11)
         variables = []
-        test_batch = self.get_stream("valid").get_epoch_iterator(as_dict=True).next()
-        for key in CANONICAL_SOURCES:
-            value = test_batch[key]
+        for key, source in schema.items():
             variable = T.TensorType(
-                broadcastable=[False]*value.ndim,
-                dtype=value.dtype)(key)
-            variable.tag.test_value = value[:11]
+                broadcastable=[False]*source.ndim,
+                dtype=source.dtype)(key)
+            if test_batch is not None:
+                variable.tag.test_value = test_batch[key]
             variables.append(variable)
         return variables
 
+    def get_example_batch(self, n_examples, rng=None):
+        """a batch of `n_examples` for use as test values or in
+        benchmarks.  made up from the source schema if it has all the
+        example shapes, otherwise taken from the validation stream."""
+        rng = rng or np.random.RandomState(1)
+        schema = self.get_source_schema()
+        if any(source.example_shape is None for source in schema.values()):
+            return self.get_example_batch_from_stream(n_examples, rng)
+        return self.synthesize_batch(schema, n_examples, rng)
+
+    def get_example_batch_from_stream(self, n_examples, rng=None):
+        rng = rng or np.random.RandomState(1)
+        batch = self.get_stream(self.example_batch_set).get_epoch_iterator(as_dict=True).next()
+        if self.ragged:
+            # the first axis of the features isn't the batch axis; take
+            # the batch as it comes
+            return batch
+        # repeat examples if the batch is too small
+        batch_size = len(batch.values()[0])
+        indices = (np.arange(n_examples) if n_examples <= batch_size
+                   else rng.randint(batch_size, size=n_examples))
+        return OrderedDict((key, value[indices]) for key, value in batch.items())
+
+    def synthesize_batch(self, schema, n_examples, rng):
+        features = schema["features"]
+        x = rng.uniform(size=(n_examples,) + features.example_shape)
+        if np.dtype(features.dtype).kind in "iu":
+            x = 255 * x
+        # a full-size example; the first axis is channels
+        x_shape = np.tile([features.example_shape[1:]], (n_examples, 1))
+        # zero is a valid target in every task
+        y = np.zeros((n_examples,) + schema["targets"].example_shape)
+        return OrderedDict([
+            ("features", x.astype(features.dtype)),
+            ("shapes", x_shape.astype(schema["shapes"].dtype)),
+            ("targets", y.astype(schema["targets"].dtype))])
+
+    def upcast(self, x):
+        # turn the features as stored into floatX for computation
+        return T.cast(x, theano.config.floatX)
+
     def get_emitter(self, input_dim, batch_normalize, **kwargs):
         return emitters.SingleSoftmax(input_dim, self.n_classes,
                                       batch_normalize=batch_normalize)
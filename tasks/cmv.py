@@ -9,7 +9,7 @@ def _canonicalize(self, data):
     # introduce channel axis
     x = np.expand_dims(x, axis=1)
     x_shape = np.tile([x.shape[2:]], (x.shape[0], 1))
-    return (x.astype(np.float32),
+    return (x.astype(self.storage_dtype),
             x_shape.astype(np.float32),
             y.astype(np.uint8))
 
@@ -20,12 +20,14 @@ class Task(tasks.Classification):
     name = "cmv"
     canonicalize = _canonicalize
     center = _center
+    n_spatial_dims = 3
 
     @util.checkargs
     def __init__(self, video_shape, **kwargs):
         self.n_channels = 1
         self.n_classes = 10
         self.video_shape = video_shape
+        self.example_shape = tuple(video_shape)
         super(Task, self).__init__(**kwargs)
 
     def load_datasets(self):
@@ -1,5 +1,6 @@
 import os, logging, cPickle, zlib, h5py, functools
 from StringIO import StringIO
+from collections import OrderedDict
 import numpy as np
 import theano, theano.tensor as T
 import fuel.transformers
@@ -54,9 +55,9 @@ class FeaturelevelUCF101Dataset(fuel.datasets.H5PYDataset):
 
 def _canonicalize(self, data):
     fc, fc_shapes, conv, conv_shapes, targets = data
-    return (fc.astype(theano.config.floatX),
+    return (fc.astype(self.storage_dtype),
             fc_shapes.astype(theano.config.floatX),
-            conv.astype(theano.config.floatX),
+            conv.astype(self.storage_dtype),
             conv_shapes.astype(theano.config.floatX),
             targets.astype(np.uint8))
 
@@ -67,24 +68,27 @@ class Task(tasks.Classification):
     name = "featurelevel_ucf101"
     canonicalize = _canonicalize
     center = _center
+    # there is no validation set
+    example_batch_set = "train"
 
     def __init__(self, *args, **kwargs):
         super(Task, self).__init__(*args, **kwargs)
         self.n_classes = 101
         self.n_channels = None # should be unused
 
-    def get_variables(self):
-        fc = T.tensor3("fc")
-        conv = T.TensorType(broadcastable=[False]*5,
-                                     dtype=theano.config.floatX)("conv")
-        fc_shapes = T.matrix("fc_shapes")
-        conv_shapes = T.matrix("conv_shapes")
-
-        targets = T.ivector("targets")
+    def get_source_schema(self):
+        # the feature shapes depend on the dataset, so test values are
+        # taken from the stream
+        floatX = theano.config.floatX
+        return OrderedDict([
+            ("fc", tasks.Source(self.storage_dtype, 3, None)),
+            ("fc_shapes", tasks.Source(floatX, 2, None)),
+            ("conv", tasks.Source(self.storage_dtype, 5, None)),
+            ("conv_shapes", tasks.Source(floatX, 2, None)),
+            ("targets", tasks.Source("int32", 1, ()))])
 
-        test_batch = self.get_stream("train").get_epoch_iterator(as_dict=True).next()
-        for key, value in test_batch.items():
-            locals()[key].tag.test_value = value[:11]
+    def get_variables(self):
+        fc, fc_shapes, conv, conv_shapes, targets = super(Task, self).get_variables()
 
         # x is secretly a tuple of these two variables; UCF101's cropper thingamajig knows about this
         x = (fc, conv)
@@ -92,6 +96,9 @@ class Task(tasks.Classification):
         y = targets
         return x, x_shape, y
 
+    def upcast(self, x):
+        return tuple(map(super(Task, self).upcast, x))
+
     def load_datasets(self):
         return dict(
             train=FeaturelevelUCF101Dataset(which_sets=["train"]),
@@ -123,13 +123,17 @@ def _canonicalize(self, data):
     y[:, -1] = lengths - 1
 
     x_shape = np.tile([x.shape[2:]], (x.shape[0], 1))
-    return (x.astype(np.float32),
+    return (x.astype(self.storage_dtype),
             x_shape.astype(np.float32),
             y.astype(np.uint8))
 
 class NumberTask(tasks.Classification):
     name = "svhn_number"
     canonicalize = _canonicalize
+    # after the random crop
+    example_shape = (54, 54)
+    # five digits and the length
+    target_shape = (6,)
 
     def __init__(self, *args, **kwargs):
         super(NumberTask, self).__init__(*args, **kwargs)
@@ -24,7 +24,7 @@ def _canonicalize(self, data):
     x, x_shape, y = data
     # introduce channel axis
     x = x[:, np.newaxis, ...]
-    return (x.astype(np.float32),
+    return (x.astype(self.storage_dtype),
             x_shape.astype(np.float32),
             y.astype(np.uint8))
 
@@ -35,6 +35,11 @@ class Task(tasks.Classification):
     name = "kth"
     canonicalize = _canonicalize
     center = _center
+    n_spatial_dims = 3
+    # the augmentation crops to the shortest video in the batch, so the
+    # duration isn't known statically
+    example_shape = None
+    supports_ragged = True
 
     def __init__(self, *args, **kwargs):
         super(Task, self).__init__(*args, **kwargs)
@@ -52,8 +57,8 @@ class Task(tasks.Classification):
         if not monitor:
             stream = fuel.transformers.Mapping(
                 stream, mapping=augment)
-        stream = transformers.PaddingShape(
-            stream, shape_sources=["videos"])
+        klass = transformers.RaggedShape if self.ragged else transformers.PaddingShape
+        stream = klass(stream, shape_sources=["videos"])
         return stream
 
     def get_stream_num_examples(self, which_set, monitor):
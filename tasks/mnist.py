@@ -6,13 +6,14 @@ def _canonicalize(self, data):
     # remove bogus singleton dimension
     y = y.flatten()
     x_shape = np.tile([x.shape[2:]], (x.shape[0], 1))
-    return (x.astype(np.float32),
+    return (x.astype(self.storage_dtype),
             x_shape.astype(np.float32),
             y.astype(np.uint8))
 
 class Task(tasks.Classification):
     name = "mnist"
     canonicalize = _canonicalize
+    example_shape = (28, 28)
 
     def __init__(self, *args, **kwargs):
         super(Task, self).__init__(*args, **kwargs)
@@ -11,7 +11,7 @@ def _canonicalize(self, data):
     x = np.rollaxis(x, x.ndim - 1, 1)
     x = np.float32(x) / 255.0
     x_shape = np.tile([x.shape[2:]], (x.shape[0], 1))
-    return (x.astype(np.float32),
+    return (x.astype(self.storage_dtype),
             x_shape.astype(np.float32),
             y.astype(np.uint8))
 
@@ -25,6 +25,7 @@ class ClutteredMNISTVideo(H5PYDataset):
 class Task(base.Classification):
     name = "cluttered_mnist_video"
     canonicalize = _canonicalize
+    n_spatial_dims = 3
 
     def __init__(self, *args, **kwargs):
         super(Task, self).__init__(*args, **kwargs)
@@ -7,13 +7,14 @@ def _canonicalize(self, data):
     y = y.flatten()
     y[y == 10] = 0
     x_shape = np.tile([x.shape[2:]], (x.shape[0], 1))
-    return (x.astype(np.float32),
+    return (x.astype(self.storage_dtype),
             x_shape.astype(np.float32),
             y.astype(np.uint8))
 
 class DigitTask(tasks.Classification):
     name = "svhn_digit"
     canonicalize = _canonicalize
+    example_shape = (32, 32)
 
     def __init__(self, *args, **kwargs):
         super(DigitTask, self).__init__(*args, **kwargs)
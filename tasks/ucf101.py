@@ -1,5 +1,7 @@
 import os, logging
 import numpy as np
+import theano
+import theano.tensor as T
 
 import tasks
 import datasets
@@ -12,7 +14,7 @@ def _canonicalize(self, data):
     # move channel axis to just after batch axis
     x = np.rollaxis(x, x.ndim - 1, 1)
     x_shape = np.tile([x.shape[2:]], (x.shape[0], 1))
-    return (x.astype(np.float32),
+    return (x.astype(self.storage_dtype),
             x_shape.astype(np.float32),
             y.astype(np.uint8))
 
@@ -23,6 +25,9 @@ class Task(tasks.Classification):
     name = "ucf101"
     canonicalize = _canonicalize
     center = _center
+    # uint8 keeps the raw pixel values, which are scaled in the graph
+    storage_dtypes = ("float32", "float16", "uint8")
+    n_spatial_dims = 3
 
     def __init__(self, *args, **kwargs):
         super(Task, self).__init__(*args, **kwargs)
@@ -31,6 +36,7 @@ class Task(tasks.Classification):
         for key in ("data_subsample data_random_subsample data_nb_frames "
                     "data_input_size data_crop_size data_crop_type translate_labels".split()):
             setattr(self, key, kwargs[key])
+        self.example_shape = (self.data_nb_frames,) + tuple(self.data_crop_size)
 
     def load_datasets(self):
         return dict(
@@ -56,8 +62,14 @@ class Task(tasks.Classification):
             nb_frames=self.data_nb_frames,
             crop_type='center' if monitor else self.data_crop_type,
             flip='noflip' if monitor else 'random',
+            dtype=self.storage_dtype,
             data_stream=stream)
 
+    def upcast(self, x):
+        if x.dtype == "uint8":
+            return T.cast(x, theano.config.floatX) / 255.
+        return super(Task, self).upcast(x)
+
     def get_stream_num_examples(self, which_set, monitor):
         if monitor and (which_set == "train" or which_set == "valid"):
             return 1000
@@ -686,7 +698,6 @@ class JpegHDF5Dataset(H5PYDataset):
         data_file.close()
 
 import PIL.Image as Image
-import time
 
 from StringIO import StringIO
 
@@ -708,6 +719,8 @@ class JpegHDF5Transformer(Transformer) :
     crop_type: random, corners or center type of cropping
     scale: pixel values are scale into the range [0, scale]
     nb_frames: maximum number of frame (will be zero padded)
+    dtype: dtype of the output images; if uint8, the raw pixel values
+           are kept and scale must be 1.
 
     """
     def __init__(self,
@@ -722,6 +735,7 @@ class JpegHDF5Transformer(Transformer) :
                  scale=1.,
                  translate_labels = False,
                  nb_frames= 25,
+                 dtype='float32',
                  *args, **kwargs):
 
         self.rng = kwargs.pop('rng', None)
@@ -739,6 +753,7 @@ class JpegHDF5Transformer(Transformer) :
         self.scale = scale
         self.mean = mean
         self.translate_labels = translate_labels
+        self.dtype = dtype
         self.data_sources = ('targets', 'images')
 
         ### multi-scale
@@ -769,6 +784,7 @@ class JpegHDF5Transformer(Transformer) :
         assert self.crop_size[0] <= self.input_size[0]
         assert self.crop_size[1] <= self.input_size[1]
         assert self.nchannels >= 1
+        assert self.dtype != 'uint8' or self.scale == 1.
 
 
     def multiscale_crop(self):
@@ -848,10 +864,8 @@ class JpegHDF5Transformer(Transformer) :
     def get_data(self, request=None):
         if request is not None:
             raise ValueError
-        timer = time.time()
         batch = next(self.child_epoch_iterator)
         images, labels = self.preprocess_data(batch)
-        timers2 = time.time()
         return images, labels
 
 
@@ -865,7 +879,7 @@ class JpegHDF5Transformer(Transformer) :
         num_videos = int(len(data_array)/fpv)
         x = np.zeros((num_videos, fpv,
                       self.crop_size[0], self.crop_size[1], self.nchannels),
-                     dtype='float32')
+                     dtype=self.dtype)
         y = np.empty(num_videos, dtype='int64')
         for i in xrange(num_videos) :
             if self.translate_labels:
@@ -893,7 +907,10 @@ class JpegHDF5Transformer(Transformer) :
                 # cv2.imshow('img', np.array(img))
                 # cv2.waitKey(0)
                 # cv2.destroyAllWindows()
-                img = (np.array(img).astype(np.float32) / 255.0) * self.scale
+                if self.dtype == 'uint8':
+                    img = np.array(img)
+                else:
+                    img = (np.array(img).astype(np.float32) / 255.0) * self.scale
 
                 if self.nchannels == 1:
                     img = img[:, :, None]
@@ -1,3 +1,5 @@
+import time
+from collections import OrderedDict
 import numpy
 import fuel.transformers
 
@@ -49,3 +51,108 @@ class PaddingShape(fuel.transformers.Transformer):
             batch_with_shapes.append(
                 numpy.array(shapes, dtype=self.shape_dtype))
         return tuple(batch_with_shapes)
+
+class RaggedShape(PaddingShape):
+    """Like PaddingShape but concatenating the examples along their
+    first axis instead of padding them all to the longest one. The other
+    axes are padded. The shapes tell where each example starts and how
+    long it is; see `pad_ragged`.
+    """
+    def transform_batch(self, batch):
+        batch_with_shapes = []
+        for i, (source, source_batch) in enumerate(
+                zip(self.data_stream.sources, batch)):
+            if source not in self.shape_sources:
+                batch_with_shapes.append(source_batch)
+                continue
+
+            shapes = [numpy.asarray(sample).shape for sample in source_batch]
+            lengths = [shape[0] for shape in shapes]
+
+            ragged_batch = numpy.zeros(
+                (sum(lengths),) + tuple(map(max, zip(*shapes)))[1:],
+                dtype=numpy.asarray(source_batch[0]).dtype)
+            offsets = numpy.cumsum([0] + lengths)
+            for sample, shape, offset in zip(source_batch, shapes, offsets):
+                ragged_batch[(slice(offset, offset + shape[0]),) +
+                             tuple(map(slice, shape[1:]))] = sample
+            batch_with_shapes.append(ragged_batch)
+
+            batch_with_shapes.append(
+                numpy.array(shapes, dtype=self.shape_dtype))
+        return tuple(batch_with_shapes)
+
+def pad_ragged(x, shapes):
+    """Turn a ragged batch of (total_length, channels) + other axes into
+    a padded one of (batch_size, channels, length) + other axes."""
+    shapes = numpy.asarray(shapes).astype(int)
+    padded = numpy.zeros(
+        (len(shapes), x.shape[1], shapes[:, 0].max()) + x.shape[2:],
+        dtype=x.dtype)
+    offsets = numpy.cumsum([0] + list(shapes[:, 0]))
+    for i, offset in enumerate(offsets[:-1]):
+        padded[i, :, :shapes[i, 0]] = numpy.rollaxis(
+            x[offset:offset + shapes[i, 0]], 1)
+    return padded
+
+def nbytes(data):
+    data = numpy.asarray(data)
+    if data.dtype == object:
+        return sum(nbytes(x) for x in data.flat)
+    return data.nbytes
+
+class Instrumented(fuel.transformers.Transformer):
+    """Pass batches through unchanged, recording the number of batches,
+    the time taken to produce them and their size in bytes into
+    `stats[name]`.
+
+    The time includes that of the stages below. `stats` is shared among
+    the stages of a pipeline, which add themselves in order from the
+    source up, so that the time spent in a stage itself is the
+    difference with the stage before it.
+    """
+    def __init__(self, data_stream, name, stats, **kwargs):
+        super(Instrumented, self).__init__(
+            data_stream, produces_examples=data_stream.produces_examples,
+            **kwargs)
+        self.name = name
+        self.stats = stats
+        self.stats[name] = dict(batches=0, seconds=0., bytes=0)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        start = time.time()
+        data = next(self.child_epoch_iterator)
+        stats = self.stats[self.name]
+        stats["seconds"] += time.time() - start
+        stats["batches"] += 1
+        stats["bytes"] += sum(map(nbytes, data))
+        return data
+
+def get_pipeline_stats(data_stream):
+    # find the stats of the outermost Instrumented stage
+    while data_stream is not None:
+        if isinstance(data_stream, Instrumented):
+            return data_stream.stats
+        data_stream = getattr(data_stream, "data_stream", None)
+    return None
+
+def summarize_pipeline_stats(stats):
+    # total time spent in the pipeline, and per stage the time in the
+    # stage itself and the size, per batch
+    summary = OrderedDict()
+    below = 0.
+    for name, stage in stats.items():
+        if stage["batches"]:
+            summary["%s_ms_per_batch" % name] = (
+                1000 * (stage["seconds"] - below) / stage["batches"])
+            summary["%s_kb_per_batch" % name] = (
+                stage["bytes"] / 1024. / stage["batches"])
+        below = stage["seconds"]
+    summary["wait_time"] = below
+    return summary
+
+def reset_pipeline_stats(stats):
+    for stage in stats.values():
+        stage.update(batches=0, seconds=0., bytes=0)
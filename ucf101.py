@@ -15,8 +15,8 @@ floatX = theano.config.floatX
 
 class UCF101Cropper(object):
     def __init__(self, patch_shape, kernel, hyperparameters):
-        self.cropper1d = Cropper(patch_shape[:1], kernel, hyperparameters, name="cropper1d")
-        self.cropper3d = Cropper(patch_shape    , kernel, hyperparameters, name="cropper3d")
+        # crops the fc and conv features with shared temporal windows
+        self.cropper = Cropper(patch_shape, kernel, hyperparameters, name="cropper")
         self.patch_shape = patch_shape
         self.n_spatial_dims = len(patch_shape)
 
@@ -45,17 +45,14 @@ class UCF101Cropper(object):
         # image is secretly two variables; conv and fc features
         fc, conv = image
         fc_shape, conv_shape = image_shape
+        # the features are aligned in time
+        (fc_patch, conv_patch), _ = self.cropper.apply_multi([
+            (fc, fc_shape[:, 1:], (0,), 1.),
+            (conv, conv_shape[:, 1:], (0, 1, 2), 1.),
+        ], location, scale)
         # (batch, 4096, 16, 1)
-        fc_patch = T.shape_padright(self.cropper1d.apply(
-            fc, fc_shape[:, 1:],
-            location[:, 0, np.newaxis],
-            scale[:, 0, np.newaxis],
-        )[0])
+        fc_patch = T.shape_padright(fc_patch)
         # (batch, 512, 16, 1, 1)
-        conv_patch = self.cropper3d.apply(
-            conv, conv_shape[:, 1:],
-            location, scale,
-        )[0]
         fc_repr = fc_patch
         #fc_repr = self.fc_conv.apply(fc_patch)
         conv_repr = self.conv_conv.apply(conv_patch)
@@ -186,6 +183,8 @@ def prepare_mode(mode, outputs, ram, emitter, hyperparameters, **kwargs):
 @util.checkargs
 def construct_graphs(task, n_patches, hyperparameters, **kwargs):
     x, x_shape, y = task.get_variables()
+    # the features may be stored at reduced precision
+    x = task.upcast(x)
 
     ram = construct_model(**hyperparameters)
     ram.initialize()
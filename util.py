@@ -1,12 +1,11 @@
 import sys, operator, logging, collections, itertools
-import numbers
+import numbers, time, resource, contextlib
 
 from collections import OrderedDict
 from cStringIO import StringIO
 
 import theano
 import theano.tensor.basic
-import theano.sandbox.cuda.blas
 import theano.printing
 import theano.scan_module.scan_utils
 import theano.tensor as T
@@ -28,11 +27,22 @@ class StdoutLines(list):
         sys.stdout = self._stdout
 
 
+def cuda_enabled():
+    # don't import theano.sandbox.cuda unless theano was told to use the
+    # gpu; it is slow to import and complains without cuda
+    if not theano.config.device.startswith("gpu"):
+        return False
+    import theano.sandbox.cuda
+    return theano.sandbox.cuda.cuda_enabled
+
 def batched_tensordot(a, b, axes=2):
+    if cuda_enabled():
+        import theano.sandbox.cuda.blas
+        dot = theano.sandbox.cuda.blas.batched_dot
+    else:
+        dot = T.batched_dot
     return theano.tensor.basic._tensordot_as_dot(
-        a, b, axes,
-        dot=theano.sandbox.cuda.blas.batched_dot,
-        batched=True)
+        a, b, axes, dot=dot, batched=True)
 
 def dedup(xs, equal=operator.is_):
     ys = []
@@ -204,6 +214,55 @@ class ExponentialDecay(SimpleExtension):
     def do(self, which_callback, *args):
         self.parameter.set_value(self.rate * self.parameter.get_value())
 
+def get_rss():
+    # resident set size in bytes, or None if /proc is unavailable
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        return None
+
+class Timeline(object):
+    """record wall time and resident memory of named phases, such as
+    those of startup.  phases may nest."""
+    def __init__(self):
+        self.phases = []
+        self.stack = []
+        self.n_begun = 0
+
+    def begin(self, name):
+        self.stack.append(dict(name=name, depth=len(self.stack),
+                               index=self.n_begun, start=time.time(),
+                               rss_before=get_rss()))
+        self.n_begun += 1
+
+    def end(self):
+        phase = self.stack.pop()
+        phase["seconds"] = time.time() - phase.pop("start")
+        phase["rss_after"] = get_rss()
+        self.phases.append(phase)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end()
+
+    def report(self):
+        from tabulate import tabulate
+        megabytes = lambda n: None if n is None else n / 2.**20
+        # phases are recorded as they end; list them as they began
+        rows = [("  " * phase["depth"] + phase["name"], phase["seconds"],
+                 megabytes(phase["rss_after"]),
+                 megabytes(phase["rss_after"] - phase["rss_before"]
+                           if phase["rss_after"] is not None else None))
+                for phase in sorted(self.phases, key=lambda phase: phase["index"])]
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2.**10
+        return "%s\npeak rss: %.1f MB" % (
+            tabulate(rows, headers="phase seconds rss_MB delta_rss_MB".split()), peak)
+
 # blocks -_-
 def uniqueify_names_last_resort(variables):
     by_name = {}
@@ -213,3 +272,28 @@ def uniqueify_names_last_resort(variables):
         (variable.copy(name="%s[%i]" % (name, i))
          for i, variable in enumerate(group))
         for name, group in by_name.items()))
+
+# label computations by where they came from, e.g. "cropper", for the
+# profiler.  the label is added to the variables' stack traces as a fake
+# frame, since theano's optimizations carry the traces of the variables
+# they replace over to the new variables (see copy_stack_trace).
+PROFILE_ORIGIN_FILENAME = "<profile origin>"
+
+def tag_profile_origin(inputs, outputs, origin):
+    frame = (PROFILE_ORIGIN_FILENAME, 0, origin, "")
+    for variable in theano.gof.graph.ancestors(outputs, blockers=inputs):
+        if variable.owner is None or variable in inputs:
+            continue
+        traces = getattr(variable.tag, "trace", [])
+        if traces and isinstance(traces[0], tuple):
+            # older theano keeps a single trace
+            traces = [traces]
+        variable.tag.trace = [list(trace) + [frame] for trace in traces] or [[frame]]
+
+def get_profile_origin(node, default="other"):
+    for output in node.outputs:
+        for trace in getattr(output.tag, "trace", []):
+            for frame in (trace if isinstance(trace, list) else [trace]):
+                if frame and frame[0] == PROFILE_ORIGIN_FILENAME:
+                    return frame[2]
+    return default